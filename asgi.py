@@ -0,0 +1,131 @@
+# Async serving mode: uvicorn asgi:app --workers 4
+#
+# The Flask routes and templates are served unchanged through a thread-pool
+# WSGI bridge. For the read paths (schedule page, cell lookups, /schedule)
+# every MongoDB round-trip the request would need -- checking loaded
+# classrooms against MongoDB once their REGISTRY_TTL has passed, loading a
+# classroom into the in-memory index and refreshing the cached weekday
+# setting -- is done
+# first on the event loop with pymongo's AsyncMongoClient, so the Flask view
+# then runs purely from memory and never parks a worker thread on I/O.
+# Updating the in-memory registry takes server._index_lock, which WSGI threads
+# may hold across a blocking query, so that part runs on an executor thread
+# and never on the event loop.
+import os
+import time
+import asyncio
+import logging
+from urllib.parse import parse_qs
+
+from a2wsgi import WSGIMiddleware
+from pymongo import AsyncMongoClient
+
+import server
+import metrics
+
+# Paths whose data can be prefetched asynchronously
+PREFETCH_PATHS = {'/', '/index', '/get_lecture', '/get_lectures', '/schedule'}
+
+wsgi_app = WSGIMiddleware(server.app, workers=int(os.getenv('ASGI_WSGI_THREADS', '16')))
+
+_async_client = None
+_loading = {}  # classroom -> asyncio.Task loading it
+
+
+def get_async_db():
+    """Return the AsyncMongoClient database, creating the client on first use."""
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncMongoClient(server.mongo_uri, event_listeners=[metrics.mongo_listener], **server.mongo_client_options())
+    return _async_client.classroomsDB
+
+
+async def refresh_settings():
+    """Refresh the cached weekday option if its TTL has expired."""
+    cache = server._settings_cache
+    if cache['weekdays'] is not None and time.monotonic() < cache['expires']:
+        return
+    doc = await get_async_db().settings.find_one({'_id': 'global'}, {'weekdays': 1})
+    await run_sync(server.cache_weekday_setting, server._weekdays_from_doc(doc))
+
+
+def run_sync(func, *args):
+    """Run a function that may wait on server._index_lock off the event loop."""
+    return asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+async def sync_classrooms(classrooms):
+    """Unload the loaded classrooms that changed in MongoDB, as server.sync_classrooms does."""
+    due = server.classrooms_due(classrooms)
+    if not due:
+        return
+    cursor = await get_async_db().classroom.aggregate(server.version_pipeline({'classroom': {'$in': due}}))
+    rows = await cursor.to_list(None)
+    await run_sync(server.apply_versions, due, server.versions_from_rows(rows))
+
+
+async def _load_classroom(classroom):
+    cursor = get_async_db().classroom.find({'classroom': classroom}, server.LECTURE_FIELDS)
+    docs = await cursor.to_list(None)
+    await run_sync(server.load_classroom_docs, classroom, docs)
+
+
+def warm_grids(classrooms):
+    """Build the cached grids of classrooms."""
+    opt = server.get_weekday_setting()
+    for c in classrooms:
+        server.get_grid(c, opt)
+
+
+async def load_classroom(classroom):
+    """Load a classroom into the in-memory index, sharing concurrent loads."""
+    if classroom in server._loaded_classrooms:
+        return
+    task = _loading.get(classroom)
+    if task is None:
+        task = _loading[classroom] = asyncio.ensure_future(_load_classroom(classroom))
+        task.add_done_callback(lambda _: _loading.pop(classroom, None))
+    await task
+
+
+async def prefetch(path, query_string):
+    """Warm every cache the Flask view for path will read."""
+    params = parse_qs(query_string.decode('latin-1'))
+    if path == '/schedule':
+        classrooms = [c for arg in params.get('classroom', []) for c in arg.split(',') if c] or server.CLASSROOMS
+    else:
+        classrooms = params.get('classroom') or (['1'] if path in ('/', '/index') else [])
+    await refresh_settings()
+    await sync_classrooms(classrooms)
+    await asyncio.gather(*(load_classroom(c) for c in classrooms))
+    if path == '/schedule':
+        await run_sync(warm_grids, classrooms)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if _async_client is not None:
+                await _async_client.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI entry point."""
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] == 'http' and not server.db_ready():
+        # first request of this worker: connect and bootstrap off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, server.ensure_db)
+    if scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD') and scope['path'] in PREFETCH_PATHS:
+        try:
+            await prefetch(scope['path'], scope.get('query_string', b''))
+        except Exception as e:
+            # the Flask view falls back to its synchronous queries
+            logging.warning('Async prefetch failed for %s: %s', scope['path'], e)
+    await wsgi_app(scope, receive, send)
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the schedule routes.
+
+Seeds a synthetic timetable into an in-process MongoDB stand-in (mongomock)
+or a real/embedded mongod (--mongo-uri), then measures index, get_lecture,
+lectures, has_conflict and insert_lecture through the Flask test client and
+through a multi-threaded HTTP load generator. Results are printed and saved
+as JSON so runs can be compared with --compare.
+
+    pip install -r requirements-dev.txt
+    python benchmark.py --classrooms 6 --lectures 40 --output bench.json
+    python benchmark.py --compare bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import random
+import argparse
+import platform
+import threading
+import http.client
+from datetime import datetime, timezone
+
+ROUTES = ['index', 'get_lecture', 'lectures', 'has_conflict', 'insert_lecture']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the classroom schedule routes')
+    parser.add_argument('--classrooms', type=int, default=6, help='number of classrooms to seed')
+    parser.add_argument('--lectures', type=int, default=40, help='lectures per classroom to seed')
+    parser.add_argument('--requests', type=int, default=500, help='requests per route and mode')
+    parser.add_argument('--threads', type=int, default=8, help='client threads for the HTTP load generator')
+    parser.add_argument('--routes', default=','.join(ROUTES), help='comma-separated routes to run')
+    parser.add_argument('--mongo-uri', help='use this MongoDB instead of mongomock (writes bench-N classrooms into it)')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the dataset and requests')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='compare against a previous results JSON file')
+    parser.add_argument('--skip-http', action='store_true', help='only run the in-process test-client mode')
+    return parser.parse_args()
+
+
+def load_server(mongo_uri):
+    """Import server.py against mongomock or the given MongoDB."""
+    if mongo_uri:
+        os.environ['MONGO_URI'] = mongo_uri
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit('mongomock is required for the in-process stand-in: pip install -r requirements-dev.txt')
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+    import server
+    server.ensure_db()
+    return server
+
+
+def clear_bench_data(server):
+    """Delete what earlier runs wrote; only bench-N classrooms and Bench instructors are touched."""
+    server.collection.delete_many({'classroom': {'$regex': '^bench-'}})
+    server.db.reservations.delete_many({'_id': {'$regex': '^(room:bench-|instructor:bench )'}})
+    server.db.history.delete_many({'kind': 'lecture', 'classroom': {'$regex': '^bench-'}})
+
+
+def seed(server, classrooms, per_classroom, rng):
+    """Insert a conflict-free synthetic timetable; returns the classroom names."""
+    # namespaced so a run against a real database never touches its classrooms
+    names = [f'bench-{i + 1}' for i in range(classrooms)]
+    clear_bench_data(server)
+    patterns = ['13', '24', '135', '5', '1', '2', '3', '4']
+    docs = []
+    for classroom in names:
+        busy = set()
+        placed = 0
+        attempts = 0
+        while placed < per_classroom and attempts < per_classroom * 50:
+            attempts += 1
+            days = rng.choice(patterns)
+            start = rng.randint(8, 19)
+            length = rng.choice([1, 1, 2, 2, 3])
+            end = min(start + length, 20)
+            cells = {(d, h) for d in days for h in range(start, end)}
+            if cells & busy:
+                continue
+            busy |= cells
+            starttime, endtime = f'{start:02d}:00', f'{end:02d}:00'
+            doc = {
+                'course': f'STAT{rng.randint(100, 499)}',
+                'instructor': f'Bench Instructor {rng.randint(1, classrooms * 10)}',
+                'days': days,
+                'starttime': starttime,
+                'endtime': endtime,
+                'numberOfStudents': str(rng.randint(10, 80)),
+                'classroom': classroom,
+            }
+            doc.update(server.time_fields(days, starttime, endtime))
+            docs.append(doc)
+            placed += 1
+    if docs:
+        server.collection.insert_many(docs)
+    return names, len(docs)
+
+
+def reset_caches(server):
+    """Drop every process-local cache so the first request of a run is cold."""
+    with server._index_lock:
+        for lec_id in list(server._lectures):
+            server.unindex_lecture(lec_id, invalidate=False)
+        server._loaded_classrooms.clear()
+        server._checked.clear()
+        server._all_loaded = False
+        server._all_checked = 0.0
+        server._grid_cache.clear()
+        server._export_cache.clear()
+        server._capacity_cache.clear()
+        server._user_cache.clear()
+        server._settings_cache.update(weekdays=None, expires=0.0)
+    with server._snapshots_lock:
+        server._snapshots.clear()
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+
+def summarize(latencies, elapsed, errors):
+    values = sorted(latencies)
+    return {
+        'requests': len(values),
+        'errors': errors,
+        'p50_ms': round(percentile(values, 50) * 1000, 3),
+        'p95_ms': round(percentile(values, 95) * 1000, 3),
+        'p99_ms': round(percentile(values, 99) * 1000, 3),
+        'max_ms': round((values[-1] if values else 0) * 1000, 3),
+        'throughput_rps': round(len(values) / elapsed, 1) if elapsed else 0.0,
+    }
+
+
+def request_factory(server, route, classrooms, rng):
+    """Return a callable producing (method, path, headers) for a route."""
+    days, _, _ = server.get_days_config()
+    counter = [0]
+
+    def make():
+        classroom = rng.choice(classrooms)
+        if route == 'index':
+            return 'GET', f'/index?classroom={classroom}', {}
+        if route == 'get_lecture':
+            hour = rng.choice(server.TIMES)
+            return 'GET', f'/get_lecture?classroom={classroom}&day={rng.choice(days)}&time={hour}', {}
+        if route == 'lectures':
+            return 'GET', f'/lectures?classroom={classroom}', {}
+        if route == 'insert_lecture':
+            counter[0] += 1
+            start = rng.randint(8, 18)
+            # a distinct instructor per insert, so only room clashes are rejected
+            query = (f'/insert_lecture?course=BENCH{counter[0]}&instructor=Bench+{counter[0]}&days={rng.choice("12345")}'
+                     f'&starttime={start:02d}:00&endtime={start + 1:02d}:00&classroom={classroom}')
+            return 'GET', query, {'X-Requested-With': 'XMLHttpRequest'}
+        raise ValueError(route)
+
+    return make
+
+
+def run_has_conflict(server, classrooms, n, rng):
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(n):
+        start = rng.randint(8, 18)
+        lecture = {'classroom': rng.choice(classrooms), 'days': rng.choice(['13', '24', '5']),
+                   'starttime': f'{start:02d}:00', 'endtime': f'{start + 1:02d}:00'}
+        t0 = time.perf_counter()
+        server.has_conflict(lecture)
+        latencies.append(time.perf_counter() - t0)
+    return summarize(latencies, time.perf_counter() - started, 0)
+
+
+def run_test_client(server, route, classrooms, n, rng):
+    client = server.app.test_client()
+    with client.session_transaction() as sess:
+        sess['user'] = 'admin'
+    make = request_factory(server, route, classrooms, rng)
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for _ in range(n):
+        method, path, headers = make()
+        t0 = time.perf_counter()
+        resp = client.open(path, method=method, headers=headers)
+        resp.get_data()
+        latencies.append(time.perf_counter() - t0)
+        if resp.status_code >= 500:
+            errors += 1
+    return summarize(latencies, time.perf_counter() - started, errors)
+
+
+def session_cookie(server):
+    """Return a Cookie header value for a logged-in admin session."""
+    app = server.app
+    serializer = app.session_interface.get_signing_serializer(app)
+    return f"{app.config['SESSION_COOKIE_NAME']}={serializer.dumps({'user': 'admin'})}"
+
+
+def run_http(server, route, classrooms, n, threads, rng):
+    from werkzeug.serving import make_server
+    httpd = make_server('127.0.0.1', 0, server.app, threaded=True)
+    port = httpd.server_port
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    cookie = session_cookie(server)
+    lock = threading.Lock()
+    make = request_factory(server, route, classrooms, rng)
+    latencies = []
+    errors = [0]
+    remaining = [n]
+
+    def worker():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+                method, path, headers = make()
+            headers = dict(headers, Cookie=cookie)
+            t0 = time.perf_counter()
+            try:
+                conn.request(method, path, headers=headers)
+                resp = conn.getresponse()
+                resp.read()
+                status = resp.status
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                status = 599
+            elapsed = time.perf_counter() - t0
+            with lock:
+                latencies.append(elapsed)
+                if status >= 500:
+                    errors[0] += 1
+        conn.close()
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    total = time.perf_counter() - started
+    httpd.shutdown()
+    return summarize(latencies, total, errors[0])
+
+
+def print_results(results, baseline=None):
+    header = f"{'route':<16}{'mode':<8}{'req':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'rps':>10}"
+    print(header)
+    print('-' * len(header))
+    base = {}
+    for row in (baseline or {}).get('results', []):
+        base[(row['route'], row['mode'])] = row
+    for row in results:
+        line = (f"{row['route']:<16}{row['mode']:<8}{row['requests']:>7}{row['p50_ms']:>10.2f}"
+                f"{row['p95_ms']:>10.2f}{row['p99_ms']:>10.2f}{row['throughput_rps']:>10.1f}")
+        old = base.get((row['route'], row['mode']))
+        if old and old['p95_ms']:
+            line += f"   p95 {100.0 * (row['p95_ms'] - old['p95_ms']) / old['p95_ms']:+.1f}%"
+        print(line)
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    server = load_server(args.mongo_uri)
+    # werkzeug logs every request of the HTTP mode at INFO
+    quiet = [logging.getLogger(), logging.getLogger('werkzeug')]
+    levels = [logger.level for logger in quiet]
+    for logger in quiet:
+        logger.setLevel(logging.WARNING)
+
+    classrooms, seeded = seed(server, args.classrooms, args.lectures, rng)
+    routes = [r for r in args.routes.split(',') if r]
+    results = []
+    for route in routes:
+        if route not in ROUTES:
+            sys.exit(f'unknown route {route!r}; choose from {", ".join(ROUTES)}')
+        reset_caches(server)
+        if route == 'has_conflict':
+            results.append(dict(route=route, mode='inproc', **run_has_conflict(server, classrooms, args.requests, rng)))
+            continue
+        results.append(dict(route=route, mode='client', **run_test_client(server, route, classrooms, args.requests, rng)))
+        if not args.skip_http:
+            reset_caches(server)
+            results.append(dict(route=route, mode='http', **run_http(server, route, classrooms, args.requests, args.threads, rng)))
+
+    if args.mongo_uri:
+        clear_bench_data(server)
+    for logger, level in zip(quiet, levels):
+        logger.setLevel(level)
+    report = {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'backend': 'mongodb' if args.mongo_uri else 'mongomock',
+        'params': {'classrooms': args.classrooms, 'lectures_per_classroom': args.lectures, 'seeded': seeded,
+                   'requests': args.requests, 'threads': args.threads, 'seed': args.seed},
+        'results': results,
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'\nResults written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
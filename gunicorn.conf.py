@@ -0,0 +1,30 @@
+# Gunicorn configuration: gunicorn -c gunicorn.conf.py wsgi:app
+# Every setting can be overridden from the environment.
+import os
+import multiprocessing
+
+bind = os.getenv('BIND', '0.0.0.0:' + os.getenv('PORT', '5000'))
+
+# Worker processes (default 2 x cores + 1) and threads per worker. With more
+# than one thread the gthread worker is used; each worker process gets its
+# own MongoClient, so keep MONGO_MAX_POOL_SIZE >= threads. Each worker also
+# keeps its own lecture registry; writes made by other workers reach it
+# within REGISTRY_TTL seconds (or at once with LECTURE_CHANGE_STREAM).
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+worker_class = 'gthread' if threads > 1 else 'sync'
+
+# Importing the app once in the master saves memory. The app does not touch
+# MongoDB at import; each worker connects on its first request.
+preload_app = os.getenv('GUNICORN_PRELOAD', '').lower() in ('1', 'true', 'yes', 'on')
+
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '5'))
+# Recycle workers periodically to bound memory growth
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '1000'))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', '100'))
+
+accesslog = os.getenv('GUNICORN_ACCESS_LOG', '-')
+errorlog = os.getenv('GUNICORN_ERROR_LOG', '-')
+loglevel = os.getenv('GUNICORN_LOG_LEVEL', 'info')
@@ -0,0 +1,188 @@
+# Request, MongoDB and template timing exposed in Prometheus text format
+import os
+import time
+import logging
+import threading
+
+from flask import Response, g, request, before_render_template, template_rendered
+from pymongo import monitoring
+
+# Histogram buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Requests slower than this many milliseconds are logged (0 disables)
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', '0'))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + '}'
+
+
+class Counter:
+    """Monotonic counter keyed by label values."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, label_values=(), amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            for values, total in sorted(self._values.items()):
+                yield f'{self.name}{_labels(self.labels, values)} {total}'
+
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by label values."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._values = {}  # label values -> [bucket counts..., count, sum]
+
+    def observe(self, label_values, value):
+        with self._lock:
+            row = self._values.get(label_values)
+            if row is None:
+                row = self._values[label_values] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+            row[-2] += 1
+            row[-1] += value
+
+    def samples(self):
+        names = self.labels + ('le',)
+        with self._lock:
+            for values, row in sorted(self._values.items()):
+                for i, bound in enumerate(self.buckets):
+                    yield f'{self.name}_bucket{_labels(names, values + (bound,))} {row[i]}'
+                yield f'{self.name}_bucket{_labels(names, values + ("+Inf",))} {row[-2]}'
+                yield f'{self.name}_count{_labels(self.labels, values)} {row[-2]}'
+                yield f'{self.name}_sum{_labels(self.labels, values)} {row[-1]:.6f}'
+
+
+REQUEST_SECONDS = Histogram('http_request_duration_seconds', 'Request latency by route.', ('endpoint', 'method', 'status'))
+REQUEST_MONGO_COMMANDS = Counter('http_request_mongo_commands_total', 'MongoDB commands issued while serving each route.', ('endpoint',))
+MONGO_SECONDS = Histogram('mongo_command_duration_seconds', 'MongoDB command latency.', ('command', 'collection'))
+MONGO_FAILURES = Counter('mongo_command_failures_total', 'Failed MongoDB commands.', ('command', 'collection'))
+TEMPLATE_SECONDS = Histogram('template_render_duration_seconds', 'Jinja template render time.', ('template',))
+
+REGISTRY = [REQUEST_SECONDS, REQUEST_MONGO_COMMANDS, MONGO_SECONDS, MONGO_FAILURES, TEMPLATE_SECONDS]
+
+# Per-thread accounting of the request being served; pymongo calls the
+# listener on the thread that issued the command.
+_local = threading.local()
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Records per-command latency and attributes commands to the current request."""
+
+    def __init__(self):
+        self._pending = {}  # request_id -> collection name
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        coll = event.command.get(event.command_name)
+        with self._lock:
+            self._pending[event.request_id] = coll if isinstance(coll, str) else ''
+
+    def _finish(self, event):
+        with self._lock:
+            coll = self._pending.pop(event.request_id, '')
+        seconds = event.duration_micros / 1e6
+        stats = getattr(_local, 'mongo', None)
+        if stats is not None:
+            stats[0] += 1
+            stats[1] += seconds
+        return (event.command_name, coll), seconds
+
+    def succeeded(self, event):
+        labels, seconds = self._finish(event)
+        MONGO_SECONDS.observe(labels, seconds)
+
+    def failed(self, event):
+        labels, seconds = self._finish(event)
+        MONGO_SECONDS.observe(labels, seconds)
+        MONGO_FAILURES.inc(labels)
+
+
+mongo_listener = MongoCommandListener()
+
+
+def render_metrics():
+    """Return all metrics in Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
+
+
+def _before_request():
+    g.metrics_start = time.perf_counter()
+    _local.mongo = [0, 0.0]
+
+
+def _after_request(response):
+    start = g.pop('metrics_start', None)
+    stats = getattr(_local, 'mongo', None)
+    if start is None or stats is None:
+        return response
+    labels = (request.endpoint or 'unmatched', request.method, str(response.status_code))
+    path = request.full_path.rstrip('?')
+
+    def finish():
+        # runs once the body has been sent, so streamed responses are timed
+        # and their MongoDB commands counted in full
+        if getattr(_local, 'mongo', None) is stats:
+            _local.mongo = None
+        elapsed = time.perf_counter() - start
+        REQUEST_SECONDS.observe(labels, elapsed)
+        REQUEST_MONGO_COMMANDS.inc(labels[:1], stats[0])
+        if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+            logging.warning('Slow request: %s %s took %.1f ms (%d mongo commands, %.1f ms)',
+                            labels[1], path, elapsed * 1000, stats[0], stats[1] * 1000)
+
+    response.call_on_close(finish)
+    return response
+
+
+def _template_started(sender, template, context, **extra):
+    _local.template_start = time.perf_counter()
+
+
+def _template_finished(sender, template, context, **extra):
+    start = getattr(_local, 'template_start', None)
+    if start is not None:
+        TEMPLATE_SECONDS.observe((template.name or 'inline',), time.perf_counter() - start)
+        _local.template_start = None
+
+
+def init_app(app):
+    """Install the timing hooks and the /metrics endpoint on app."""
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_finished, app)
+    app.add_url_rule('/metrics', 'metrics', lambda: Response(render_metrics(), mimetype='text/plain; version=0.0.4'))
@@ -1,10 +1,35 @@
 # Simple Flask app using MongoDB
 import os
+import io
+import csv
+import gzip
+import json
+import bisect
+import hmac
+import hashlib
+import heapq
 import logging
+import threading
+import time
+import queue
+import tempfile
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+import click
+import pymongo
 from dotenv import load_dotenv
-from pymongo import MongoClient
-from flask import Flask, request, redirect, render_template, jsonify, session, url_for
+from pymongo import MongoClient, UpdateOne
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+from pymongo.errors import BulkWriteError
+from flask import Flask, Blueprint, abort, current_app, request, redirect, render_template, jsonify, session, send_file, url_for, make_response, Response
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import escape
+from werkzeug.security import generate_password_hash, check_password_hash
 from bson.objectid import ObjectId
+import metrics
+import solver
 
 # Load environment variables
 load_dotenv()
@@ -15,28 +40,131 @@ logging.basicConfig(level=logging.INFO)
 # Getting the data from process.html form then
 # inserting data in MongoDB classroomsDB database
 # connecting to the database
+mongo_uri = os.getenv('MONGO_URI', 'mongodb://localhost:27017')
 client = None
-try:
-    mongo_uri = os.getenv('MONGO_URI', 'mongodb://localhost:27017')
-    client = MongoClient(mongo_uri)
-    print("Connected successfully!!!")
-except Exception as e:
-    print(f"Could not connect to MongoDB: {e}")
-
-# database
-if client:
-    db = client.classroomsDB
-    collection = db.classroom
-        # Initialization remains minimal
+db = None
+collection = None
+schedule_reads = None  # `collection` routed by MONGO_READ_PREFERENCE
+history_reads = None  # db.history, routed the same way
+_db_pid = None  # pid that created `client`; MongoClient is not fork-safe
+_db_initialized = False
+
+# Fields the routes read from lecture documents
+LECTURE_FIELDS = {'course': 1, 'instructor': 1, 'days': 1, 'starttime': 1, 'endtime': 1, 'numberOfStudents': 1, 'classroom': 1,
+                  'start_min': 1, 'end_min': 1, 'day_mask': 1, 'version': 1}
+
+# MongoClient options read from the environment (unset ones keep pymongo defaults)
+MONGO_CLIENT_ENV = {
+    'maxPoolSize': 'MONGO_MAX_POOL_SIZE',
+    'minPoolSize': 'MONGO_MIN_POOL_SIZE',
+    'maxIdleTimeMS': 'MONGO_MAX_IDLE_TIME_MS',
+    'waitQueueTimeoutMS': 'MONGO_WAIT_QUEUE_TIMEOUT_MS',
+    'serverSelectionTimeoutMS': 'MONGO_SERVER_SELECTION_TIMEOUT_MS',
+    'connectTimeoutMS': 'MONGO_CONNECT_TIMEOUT_MS',
+    'socketTimeoutMS': 'MONGO_SOCKET_TIMEOUT_MS',
+}
+MONGO_CLIENT_FLAGS = {
+    'retryWrites': 'MONGO_RETRY_WRITES',
+    'retryReads': 'MONGO_RETRY_READS',
+}
+
+# Read preference for schedule reads that bypass the in-memory registry
+# (/lectures, uncached /schedule grids). Registry loads, which back
+# has_conflict, and all writes stay on the primary.
+READ_PREFERENCES = {
+    'primary': Primary,
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest,
+}
+
+
+def mongo_client_options():
+    """Return MongoClient keyword arguments configured through the environment."""
+    options = {}
+    for option, var in MONGO_CLIENT_ENV.items():
+        value = os.getenv(var)
+        if value:
+            options[option] = int(value)
+    for option, var in MONGO_CLIENT_FLAGS.items():
+        if os.getenv(var):
+            options[option] = env_flag(var)
+    return options
+
+
+def schedule_read_preference():
+    """Return the read preference for schedule reads from MONGO_READ_PREFERENCE."""
+    name = os.getenv('MONGO_READ_PREFERENCE', 'primary')
+    mode = READ_PREFERENCES.get(name)
+    if mode is None:
+        logging.warning('Unknown MONGO_READ_PREFERENCE %r; using primary', name)
+        return Primary()
+    staleness = os.getenv('MONGO_MAX_STALENESS_SECONDS')
+    if name == 'primary' or not staleness:
+        return mode()
+    # MongoDB requires at least 90 seconds
+    return mode(max_staleness=max(90, int(staleness)))
+
+
+def connect_db():
+    """Create this process's MongoClient and bind db/collection."""
+    global client, db, collection, schedule_reads, history_reads, _db_pid
+    _db_pid = os.getpid()
+    try:
+        client = MongoClient(mongo_uri, event_listeners=[metrics.mongo_listener], **mongo_client_options())
+        print("Connected successfully!!!")
+    except Exception as e:
+        client = None
+        print(f"Could not connect to MongoDB: {e}")
+    if client:
+        db = client.classroomsDB
+        collection = db.classroom
+        schedule_reads = collection.with_options(read_preference=schedule_read_preference())
+        history_reads = db.history.with_options(read_preference=schedule_read_preference())
+    else:
+        print("Warning: No MongoDB connection. Database operations will fail.")
+        db = None
+        collection = None
+        schedule_reads = None
+        history_reads = None
+
+
+def ensure_indexes():
+    """Create the indexes the read paths rely on and verify they exist."""
+    wanted = [
+        (collection, [('classroom', 1), ('days', 1), ('starttime', 1)], {'name': 'classroom_days_starttime'}),
+        # /lectures pages by _id within a classroom
+        (collection, [('classroom', 1), ('_id', 1)], {'name': 'classroom_id'}),
+        (db.users, [('username', 1)], {'name': 'username_unique', 'unique': True}),
+        (db.history, [('kind', 1), ('classroom', 1), ('ts', 1)], {'name': 'kind_classroom_ts'}),
+    ]
+    for coll, keys, opts in wanted:
+        try:
+            coll.create_index(keys, **opts)
+            if opts['name'] not in coll.index_information():
+                logging.warning('Index %s missing on %s after creation', opts['name'], coll.name)
+        except Exception as e:
+            logging.warning('Could not create index %s on %s: %s', opts['name'], coll.name, e)
+
+
+def init_db():
+    """Ensure the default user, settings document and indexes exist; return True on success.
+
+    Safe to run repeatedly and from several processes at once.
+    """
+    global _db_initialized
+    if db is None:
+        return False
     # ensure default user and settings
     try:
         existing = db.list_collection_names()
         if 'users' not in existing:
-            db.users.insert_one({
-                'username': 'admin',
-                'password': 'password',
+            # upsert so concurrent workers create a single admin
+            db.users.update_one({'username': 'admin'}, {'$setOnInsert': {
+                'password': generate_password_hash('password', method=PASSWORD_HASH_METHOD),
                 'role': 'admin'
-            })
+            }}, upsert=True)
             logging.info('Created users collection and inserted default admin user')
         else:
             logging.info('Users collection already exists; skipping creation')
@@ -47,82 +175,992 @@ if client:
         else:
             # Make sure the document exists
             db.settings.update_one({'_id': 'global'}, {'$setOnInsert': {'weekdays': 'sun-thu'}}, upsert=True)
+        if 'reservations' not in existing:
+            # no drop: other workers may be building it at the same time
+            lectures, _ = rebuild_reservations(drop=False)
+            logging.info('Built slot reservations for %d lectures', lectures)
+        seeded = seed_history()
+        if seeded is not None:
+            logging.info('Seeded schedule history with %d lectures', seeded)
     except Exception as e:
         logging.warning('Could not ensure users collection: %s', e)
-else:
-    print("Warning: No MongoDB connection. Database operations will fail.")
-    db = None
-    collection = None
+        return False
+    ensure_indexes()
+    _db_initialized = True
+    return True
+
+
+# Connection and bootstrap happen on first use rather than at import, so
+# importing the module, forking workers and running tests stay instant.
+# DB_BOOTSTRAP=0 leaves bootstrapping to `flask init-db`.
+_db_lock = threading.Lock()
+
+
+def db_ready():
+    """Return True if this process is connected and, unless disabled, bootstrapped."""
+    return _db_pid == os.getpid() and (_db_initialized or not env_flag('DB_BOOTSTRAP', True))
+
+
+def ensure_db():
+    """Connect and bootstrap the database once per process."""
+    if db_ready():
+        return
+    with _db_lock:
+        if _db_pid != os.getpid():
+            connect_db()
+            start_watchers()
+        if not _db_initialized and env_flag('DB_BOOTSTRAP', True):
+            init_db()
 
 #####################################
 
-def has_conflict(new_lecture):
-    """Detect classroom time conflicts."""
+# parse HH:MM into minutes
+def parse_time_min(t):
+    """Return minutes since midnight for an 'HH:MM' string, or None."""
+    if not isinstance(t, str) or ':' not in t:
+        return None
+    try:
+        h = int(t.split(':')[0])
+        m = int(t.split(':')[1])
+        return h * 60 + m
+    except Exception:
+        return None
+
+
+def normalize_hour(h):
+    """Apply the schedule's PM heuristic: hours before 8 are afternoon hours."""
+    return h + 12 if h < 8 else h
+
+
+def normalize_minutes(t):
+    """Return minutes since midnight for 'HH:MM' with the PM heuristic applied, or None."""
+    m = parse_time_min(t)
+    if m is None:
+        return None
+    return m + 12 * 60 if m < 8 * 60 else m
+
+
+# Day codes '1'..'5' map to bits 0..4 of day_mask
+DAY_CODES = ['1', '2', '3', '4', '5']
+
+
+def days_to_mask(days):
+    """Return the bitmask for a day-code string such as '135'."""
+    mask = 0
+    for d in days or '':
+        if d in DAY_CODES:
+            mask |= 1 << DAY_CODES.index(d)
+    return mask
+
+
+def mask_to_days(mask):
+    """Return the day-code string for a bitmask."""
+    return ''.join(d for i, d in enumerate(DAY_CODES) if mask & (1 << i))
+
+
+def time_fields(days, starttime, endtime):
+    """Return the normalized fields stored next to a lecture's display strings."""
+    return {
+        'start_min': normalize_minutes(starttime),
+        'end_min': normalize_minutes(endtime),
+        'day_mask': days_to_mask(days),
+    }
+
+
+def lecture_times(lec):
+    """Return (start_min, end_min, day_mask), computing them for unmigrated documents."""
+    if lec.get('start_min') is not None and lec.get('end_min') is not None and 'day_mask' in lec:
+        return lec['start_min'], lec['end_min'], lec['day_mask']
+    f = time_fields(lec.get('days'), lec.get('starttime'), lec.get('endtime'))
+    return f['start_min'], f['end_min'], f['day_mask']
+
+
+def lecture_hours(lec):
+    """Return the normalized hours a lecture covers, or None if its times are invalid."""
+    start, end, _ = lecture_times(lec)
+    if start is None or end is None:
+        return None
+    return list(range(start // 60, end // 60))
+
+
+def hour_key(h):
+    """Return the grid time key ('08'..'12', '01'..'07') for a normalized hour."""
+    return f"{h:02d}" if h <= 12 else f"{h-12:02d}"
+
+
+def format_minutes(m):
+    """Return 'HH:MM' for minutes since midnight."""
+    return f'{m // 60:02d}:{m % 60:02d}'
+
+
+def minute_bits(start, end):
+    """Return an int bitmap with bits start..end-1 set (one bit per minute)."""
+    return ((1 << (end - start)) - 1) << start if end > start else 0
+
+
+class IntervalIndex:
+    """Sorted (start, end, id) intervals per (key, day) for O(log n) overlap lookups.
+
+    Each bucket also keeps a minute bitmap of its busy time, so "is this
+    window free" is a single AND.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._buckets = {}  # (key, day) -> {'starts': [...], 'items': [...], 'max_len': int, 'bits': int}
+        self._members = {}  # id -> [(key, day, item)]
+
+    def add(self, key, item_id, days, start, end):
+        """Index item_id on every day in days; replaces any previous entry."""
+        with self._lock:
+            self.remove(item_id)
+            placed = []
+            for d in set(days):
+                bucket = self._buckets.setdefault((key, d), {'starts': [], 'items': [], 'max_len': 0, 'bits': 0})
+                item = (start, end, item_id)
+                i = bisect.bisect_right(bucket['items'], item)
+                bucket['starts'].insert(i, start)
+                bucket['items'].insert(i, item)
+                bucket['max_len'] = max(bucket['max_len'], end - start)
+                bucket['bits'] |= minute_bits(start, end)
+                placed.append((key, d, item))
+            self._members[item_id] = placed
+
+    def remove(self, item_id):
+        """Drop item_id from every bucket it was indexed in."""
+        with self._lock:
+            for key, d, item in self._members.pop(item_id, []):
+                bucket = self._buckets.get((key, d))
+                if not bucket:
+                    continue
+                i = bisect.bisect_left(bucket['items'], item)
+                if i < len(bucket['items']) and bucket['items'][i] == item:
+                    del bucket['items'][i]
+                    del bucket['starts'][i]
+                    # other items may cover the same minutes, so rebuild
+                    bits = 0
+                    for s, e, _ in bucket['items']:
+                        bits |= minute_bits(s, e)
+                    bucket['bits'] = bits
+
+    def busy_bits(self, key, day):
+        """Return the minute bitmap of time taken under key on day."""
+        bucket = self._buckets.get((key, day))
+        return bucket['bits'] if bucket else 0
+
+    def overlapping(self, key, days, start, end, exclude=None):
+        """Return ids of items under key overlapping [start, end) on any of days."""
+        found = []
+        with self._lock:
+            for d in days:
+                bucket = self._buckets.get((key, d))
+                if not bucket:
+                    continue
+                # only items starting before `end` and no earlier than
+                # start - max_len can reach into the window
+                hi = bisect.bisect_left(bucket['starts'], end)
+                lo = bisect.bisect_right(bucket['starts'], start - bucket['max_len'])
+                for s, e, item_id in bucket['items'][lo:hi]:
+                    if s < end and start < e and item_id != exclude and item_id not in found:
+                        found.append(item_id)
+        return found
+
+
+# In-memory lecture registry and per-classroom interval index. Each classroom
+# is loaded from MongoDB on first use, then kept current by the write routes
+# so conflict checks never touch the database. Writes made by other worker
+# processes are picked up by sync_classrooms (or LECTURE_CHANGE_STREAM).
+_lectures = {}  # str(_id) -> lecture doc (jsonable)
+_by_classroom = {}  # classroom -> {str(_id): None}, in load/insert order
+_occupancy = {}  # (classroom, day code, normalized hour) -> [str(_id), ...]
+_loaded_classrooms = set()
+_all_loaded = False  # every classroom loaded, so the instructor index is complete
+_index_lock = threading.RLock()
+classroom_index = IntervalIndex()
+instructor_index = IntervalIndex()  # keyed by instructor_key()
+
+
+def instructor_key(name):
+    """Return the case- and whitespace-insensitive key for an instructor name, or None."""
+    key = ' '.join(str(name or '').split()).casefold()
+    return key or None
+
+
+def lecture_out(lec):
+    """Return a jsonable copy of a lecture document."""
+    out = {k: v for k, v in lec.items() if k != '_id'}
+    out['_id'] = str(lec['_id'])
+    return out
+
+
+def _lecture_cells(lec):
+    """Return the (classroom, day code, hour) cells a lecture occupies."""
+    hours = lecture_hours(lec) or []
+    _, _, mask = lecture_times(lec)
+    return [(lec.get('classroom'), d, h) for d in mask_to_days(mask) for h in hours]
+
+
+def index_lecture(lec, invalidate=True):
+    """Add or replace a lecture in the in-memory index."""
+    lec_id = str(lec['_id'])
+    with _index_lock:
+        old = _lectures.get(lec_id)
+        unindex_lecture(lec_id, invalidate=False)
+        _lectures[lec_id] = lecture_out(lec)
+        _by_classroom.setdefault(lec.get('classroom'), {})[lec_id] = None
+        for cell in _lecture_cells(lec):
+            _occupancy.setdefault(cell, []).append(lec_id)
+        start, end, mask = lecture_times(lec)
+        if start is None or end is None:
+            logging.warning('Lecture %s not indexed due to invalid times: start=%r end=%r', lec_id, lec.get('starttime'), lec.get('endtime'))
+        else:
+            classroom_index.add(lec.get('classroom'), lec_id, mask_to_days(mask), start, end)
+            if instructor_key(lec.get('instructor')):
+                instructor_index.add(instructor_key(lec.get('instructor')), lec_id, mask_to_days(mask), start, end)
+        if invalidate:
+            invalidate_classroom(*{lec.get('classroom'), (old or {}).get('classroom', lec.get('classroom'))})
+
+
+def unindex_lecture(lec_id, invalidate=True):
+    """Remove a lecture from the in-memory index."""
+    with _index_lock:
+        classroom_index.remove(lec_id)
+        instructor_index.remove(lec_id)
+        old = _lectures.pop(lec_id, None)
+        if old is not None:
+            _by_classroom.get(old.get('classroom'), {}).pop(lec_id, None)
+            for cell in _lecture_cells(old):
+                ids = _occupancy.get(cell)
+                if ids and lec_id in ids:
+                    ids.remove(lec_id)
+                    if not ids:
+                        del _occupancy[cell]
+            if invalidate:
+                invalidate_classroom(old.get('classroom'))
+
+
+def load_classroom_docs(classroom, docs):
+    """Index lectures fetched for a classroom and mark it loaded.
+
+    Lectures already in the registry were indexed by a write that raced with
+    the fetch and are newer, so they are kept as they are.
+    """
+    with _index_lock:
+        if classroom in _loaded_classrooms:
+            return
+        for lec in docs:
+            if str(lec['_id']) not in _lectures:
+                index_lecture(lec, invalidate=False)
+        # unknown, empty classrooms (any ?classroom= value) are not kept
+        if known_classroom(classroom):
+            _loaded_classrooms.add(classroom)
+            _checked[classroom] = time.monotonic()
+
+
+def known_classroom(classroom):
+    """Return True for a classroom tab or a classroom with indexed lectures."""
+    return classroom in CLASSROOMS or bool(_by_classroom.get(classroom))
+
+
+# Every worker process has its own registry. A loaded classroom is compared
+# with MongoDB at most every REGISTRY_TTL seconds -- lecture count, newest
+# _id and the sum of edit versions, from one aggregation -- and dropped when
+# another process has changed it, so the next read reloads it.
+REGISTRY_TTL = float(os.getenv('REGISTRY_TTL', '5'))
+_checked = {}  # classroom -> monotonic time it was loaded or last compared
+_all_checked = 0.0
+
+
+def registry_version(classroom):
+    """Return (count, newest _id, version sum) of the indexed lectures of a classroom."""
+    ids = _by_classroom.get(classroom, {})
+    return len(ids), max(ids, default=None), sum(_lectures[i].get('version') or 0 for i in ids)
+
+
+def version_pipeline(match):
+    """Return the aggregation grouping the stored lectures matching match into per-classroom versions."""
+    return [
+        {'$match': match},
+        {'$group': {'_id': '$classroom', 'n': {'$sum': 1}, 'last': {'$max': '$_id'}, 'v': {'$sum': '$version'}}},
+    ]
+
+
+def stored_versions(match):
+    """Return {classroom: (count, newest _id, version sum)} for the stored lectures matching match."""
+    return versions_from_rows(collection.aggregate(version_pipeline(match)))
+
+
+def versions_from_rows(rows):
+    """Turn version_pipeline rows into {classroom: (count, newest _id, version sum)}."""
+    return {row['_id']: (row['n'], str(row['last']), row['v']) for row in rows}
+
+
+def unload_classroom(classroom):
+    """Drop a classroom's lectures from the registry so its next use reloads it."""
+    global _all_loaded
+    with _index_lock:
+        for lec_id in list(_by_classroom.get(classroom, {})):
+            unindex_lecture(lec_id, invalidate=False)
+        _loaded_classrooms.discard(classroom)
+        _all_loaded = False
+        invalidate_classroom(classroom)
+
+
+def classrooms_due(classrooms):
+    """Return the loaded classrooms whose registry was not compared with MongoDB within REGISTRY_TTL."""
+    now = time.monotonic()
+    return [c for c in set(classrooms) if c in _loaded_classrooms and now - _checked.get(c, 0) >= REGISTRY_TTL]
+
+
+def apply_versions(due, stored):
+    """Unload the classrooms in due whose stored versions no longer match the registry."""
+    now = time.monotonic()
+    with _index_lock:
+        for c in due:
+            _checked[c] = now
+            if c in _loaded_classrooms and stored.get(c, (0, None, 0)) != registry_version(c):
+                logging.info('Classroom %s was changed by another process; reloading', c)
+                unload_classroom(c)
+
+
+def sync_classrooms(classrooms):
+    """Unload the given loaded classrooms that changed in MongoDB since they were last compared."""
+    due = classrooms_due(classrooms)
+    if due:
+        apply_versions(due, stored_versions({'classroom': {'$in': due}}))
+
+
+def ensure_classroom_loaded(classroom):
+    """Load a classroom's lectures into the index on first use."""
+    sync_classrooms([classroom])
+    if classroom in _loaded_classrooms:
+        return
+    with _index_lock:
+        if classroom in _loaded_classrooms:
+            return
+        load_classroom_docs(classroom, collection.find({'classroom': classroom}, LECTURE_FIELDS))
+
+
+def ensure_classrooms_loaded(classrooms):
+    """Load every classroom not yet in the index with a single query."""
+    sync_classrooms(classrooms)
+    missing = [c for c in classrooms if c not in _loaded_classrooms]
+    if not missing:
+        return
+    with _index_lock:
+        missing = [c for c in missing if c not in _loaded_classrooms]
+        if not missing:
+            return
+        docs = {c: [] for c in missing}
+        for lec in collection.find({'classroom': {'$in': missing}}, LECTURE_FIELDS):
+            docs[lec['classroom']].append(lec)
+        for classroom, lectures in docs.items():
+            load_classroom_docs(classroom, lectures)
+
+
+def ensure_all_loaded():
+    """Load every classroom, including ones outside CLASSROOMS, with a single query."""
+    global _all_loaded, _all_checked
+    if _all_loaded and time.monotonic() - _all_checked >= REGISTRY_TTL:
+        # one aggregation also finds classrooms other processes created
+        now = time.monotonic()
+        stored = stored_versions({})
+        with _index_lock:
+            for c in set(stored) | _loaded_classrooms:
+                _checked[c] = now
+                if c not in _loaded_classrooms or stored.get(c, (0, None, 0)) != registry_version(c):
+                    unload_classroom(c)
+            _all_checked = now
+    if _all_loaded:
+        return
+    with _index_lock:
+        if _all_loaded:
+            return
+        docs = {c: [] for c in CLASSROOMS if c not in _loaded_classrooms}
+        for lec in collection.find({'classroom': {'$nin': list(_loaded_classrooms)}}, LECTURE_FIELDS):
+            docs.setdefault(lec.get('classroom'), []).append(lec)
+        for classroom, lectures in docs.items():
+            load_classroom_docs(classroom, lectures)
+        _all_loaded = True
+        _all_checked = time.monotonic()
+
+
+def lookup_cell(classroom, day_code, hour):
+    """Return the lecture occupying a grid cell, or None."""
+    ensure_classroom_loaded(classroom)
+    with _index_lock:
+        ids = _occupancy.get((classroom, day_code, hour))
+        return dict(_lectures[ids[0]]) if ids else None
+
+
+def classroom_lectures(classroom):
+    """Return the indexed lecture docs for a classroom."""
+    ensure_classroom_loaded(classroom)
+    with _index_lock:
+        return [_lectures[i] for i in _by_classroom.get(classroom, {})]
+
+
+def has_conflict(new_lecture, exclude_id=None):
+    """Return the lectures in the same classroom that overlap new_lecture (empty list if none)."""
     classroom = new_lecture.get('classroom')
     if not classroom:
         logging.warning('Conflict check skipped: classroom value missing')
-        return False
-    days = new_lecture['days']
-    start = new_lecture['starttime']
-    end = new_lecture['endtime']
-    
-    # parse HH:MM into minutes
-    def parse_time_min(t):
-        if not t or ':' not in t:
-            return None
+        return []
+    start_min, end_min, mask = lecture_times(new_lecture)
+    if start_min is None or end_min is None:
+        logging.warning('Skipping conflict check: invalid times for new_lecture: start=%r end=%r', new_lecture.get('starttime'), new_lecture.get('endtime'))
+        return []
+
+    ensure_classroom_loaded(classroom)
+    ids = classroom_index.overlapping(classroom, mask_to_days(mask), start_min, end_min, exclude=exclude_id)
+    return [dict(_lectures[i]) for i in ids if i in _lectures]
+
+
+def instructor_conflicts(new_lecture, exclude_id=None):
+    """Return the lectures in any classroom that overlap new_lecture and have the same instructor."""
+    key = instructor_key(new_lecture.get('instructor'))
+    start_min, end_min, mask = lecture_times(new_lecture)
+    if not key or start_min is None or end_min is None:
+        return []
+    ensure_all_loaded()
+    ids = instructor_index.overlapping(key, mask_to_days(mask), start_min, end_min, exclude=exclude_id)
+    return [dict(_lectures[i]) for i in ids if i in _lectures]
+
+
+def timetable_conflicts():
+    """Return overlapping lecture pairs by classroom and by instructor, from one sweep."""
+    ensure_all_loaded()
+    intervals = []
+    with _index_lock:
+        for lec_id, lec in _lectures.items():
+            start, end, mask = lecture_times(lec)
+            if start is None or end is None:
+                continue
+            for kind, key in sweep_keys(lec):
+                intervals.extend(((kind, key), d, start, end, (kind, lec_id, d)) for d in mask_to_days(mask))
+        lectures = dict(_lectures)
+    report = {'classroom': {}, 'instructor': {}}
+    for (kind, a, day), (_, b, _) in find_overlaps(intervals):
+        report[kind].setdefault(tuple(sorted((a, b))), set()).add(day)
+    return {kind: [{'lectures': [lectures[a], lectures[b]], 'days': ''.join(sorted(days))}
+                   for (a, b), days in sorted(found.items())] for kind, found in report.items()}
+
+
+# Slot reservations. Every lecture owns one document per (classroom, day,
+# slot) and per (instructor, day, slot) it occupies in db.reservations, with
+# the slot as _id. Writers claim their slots with an ordered insert_many in
+# _id order, so of two overlapping writers exactly one wins their first
+# common slot and the other is rejected and rolls back, while writers to
+# different rooms never touch the same documents.
+RESERVATION_SLOT_MINUTES = int(os.getenv('RESERVATION_SLOT_MINUTES', '5'))
+
+
+def reservation_ids(lec):
+    """Return the sorted slot _ids a lecture occupies."""
+    start, end, mask = lecture_times(lec)
+    if start is None or end is None or start >= end:
+        return []
+    slots = range(start // RESERVATION_SLOT_MINUTES, -(-end // RESERVATION_SLOT_MINUTES))
+    keys = [f"room:{lec.get('classroom')}"]
+    if instructor_key(lec.get('instructor')):
+        keys.append(f"instructor:{instructor_key(lec.get('instructor'))}")
+    return sorted(f'{key}:{d}:{slot}' for key in keys for d in mask_to_days(mask) for slot in slots)
+
+
+def release_slots(lec_id, slot_ids):
+    """Delete the given reservations held by lec_id."""
+    if slot_ids:
+        db.reservations.delete_many({'_id': {'$in': list(slot_ids)}, 'lecture': lec_id})
+
+
+def reserve_slots(lec_id, slot_ids):
+    """Claim slot_ids for lec_id.
+
+    Returns None on success. Otherwise nothing is kept and the ids of the
+    lectures holding the contested slots are returned (empty if they were
+    released in the meantime).
+    """
+    if not slot_ids:
+        return None
+    try:
+        db.reservations.insert_many([{'_id': slot, 'lecture': lec_id} for slot in slot_ids], ordered=True)
+        return None
+    except BulkWriteError as e:
+        release_slots(lec_id, slot_ids)
+        if any(err.get('code') != 11000 for err in e.details.get('writeErrors', [])):
+            raise
+    holders = db.reservations.find({'_id': {'$in': list(slot_ids)}, 'lecture': {'$ne': lec_id}}, {'lecture': 1})
+    return sorted({str(h['lecture']) for h in holders})
+
+
+def find_lectures(ids):
+    """Return lecture docs for ids, from the registry where possible."""
+    found = [dict(_lectures[i]) for i in ids if i in _lectures]
+    missing = [ObjectId(i) for i in ids if i not in _lectures]
+    if missing:
+        found += [lecture_out(d) for d in collection.find({'_id': {'$in': missing}}, LECTURE_FIELDS)]
+    return found
+
+
+def rebuild_reservations(drop=True):
+    """Recreate db.reservations from the lecture collection; return (lectures, clashing lectures)."""
+    if drop:
+        db.reservations.drop()
+    lectures = clashes = 0
+    batch = []
+    owners = []
+
+    def flush():
+        nonlocal clashes
         try:
-            h = int(t.split(':')[0])
-            m = int(t.split(':')[1])
-            return h * 60 + m
-        except Exception:
-            return None
+            db.reservations.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            clashes += len({owners[err['index']] for err in e.details.get('writeErrors', []) if err.get('code') == 11000})
+        batch.clear()
+        owners.clear()
 
-    # normalize times
-    start_min = parse_time_min(start)
-    end_min = parse_time_min(end)
-    if start_min is None or end_min is None:
-        logging.warning('Skipping conflict check: invalid times for new_lecture: start=%r end=%r', start, end)
-        return False
-    
-    # lectures for this classroom
-    existing = list(collection.find({"classroom": classroom}))
-    
-    for lec in existing:
-        lec_days = lec['days']
-        lec_start = lec['starttime']
-        lec_end = lec['endtime']
-        # convert lecture times
-        lec_start_min = parse_time_min(lec_start)
-        lec_end_min = parse_time_min(lec_end)
-        if lec_start_min is None or lec_end_min is None:
-            logging.warning('Skipping existing lecture during conflict check due to invalid times: %r', lec)
+    for lec in collection.find({}, LECTURE_FIELDS):
+        lectures += 1
+        for slot in reservation_ids(lec):
+            batch.append({'_id': slot, 'lecture': lec['_id']})
+            owners.append(lec['_id'])
+        if len(batch) >= 1000:
+            flush()
+    if batch:
+        flush()
+    return lectures, clashes
+
+
+# Schedule history. Every write appends a delta to db.history instead of
+# copying the timetable: {'kind': 'lecture', 'classroom', 'ts', 'lecture',
+# 'op': 'upsert' | 'delete', 'doc'} per lecture per classroom it enters or
+# leaves, and {'kind': 'settings', 'ts', 'weekdays'} per settings change.
+# The {'_id': 'baseline'} document marks that the lectures stored before the
+# history existed have been recorded. A classroom as of a time is the fold of
+# its deltas up to then; folded snapshots are kept in an LRU keyed by the
+# deltas they include, so every as_of between two changes shares one entry.
+SNAPSHOT_CACHE_SIZE = int(os.getenv('SNAPSHOT_CACHE_SIZE', '64'))
+HISTORY_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_snapshots = OrderedDict()  # (classroom, delta count, newest delta _id) -> [lecture docs]
+_snapshots_lock = threading.Lock()
+
+
+def lecture_delta(lec, op='upsert', classroom=None, ts=None):
+    """Return the history delta for a lecture entering (upsert) or leaving (delete) a classroom."""
+    return {
+        'kind': 'lecture',
+        'classroom': classroom if classroom is not None else lec.get('classroom'),
+        'ts': ts or datetime.now(timezone.utc),
+        'lecture': lec['_id'],
+        'op': op,
+        'doc': {k: lec.get(k) for k in LECTURE_FIELDS} if op == 'upsert' else None,
+    }
+
+
+def record_history(deltas):
+    """Append deltas to the history; a failure is logged, never raised to the writer."""
+    if not deltas:
+        return
+    try:
+        db.history.insert_many(deltas, ordered=False)
+    except Exception as e:
+        logging.warning('Could not record schedule history: %s', e)
+
+
+def seed_history():
+    """Record the current timetable and settings as the start of the history, once per database.
+
+    Returns the number of lectures seeded, or None if another process
+    already claimed the baseline. Lectures and settings that writes made
+    before seeding already recorded are left alone.
+    """
+    # claim the baseline marker, so exactly one process seeds
+    claim = db.history.update_one({'_id': 'baseline'}, {'$setOnInsert': {'kind': 'baseline', 'ts': datetime.now(timezone.utc)}}, upsert=True)
+    if claim.upserted_id is None:
+        return None
+    try:
+        recorded = set(db.history.distinct('lecture', {'kind': 'lecture'}))
+        deltas = []
+        if db.history.find_one({'kind': 'settings'}, {'_id': 1}) is None:
+            deltas.append({'kind': 'settings', 'ts': HISTORY_EPOCH, 'weekdays': get_weekday_setting()})
+        seeded = 0
+        for lec in collection.find({}, LECTURE_FIELDS):
+            if lec['_id'] not in recorded:
+                # the _id timestamp is the best guess for when the lecture appeared
+                deltas.append(lecture_delta(lec, ts=lec['_id'].generation_time))
+                seeded += 1
+        record_history(deltas)
+    except Exception:
+        db.history.delete_one({'_id': 'baseline'})
+        raise
+    return seeded
+
+
+def parse_as_of(value):
+    """Return an ISO date/datetime string as a naive UTC datetime (how pymongo returns dates)."""
+    as_of = datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+    if as_of.tzinfo is not None:
+        return as_of.astimezone(timezone.utc).replace(tzinfo=None)
+    if len(value) == 10:
+        # a bare date means the end of that day
+        as_of += timedelta(days=1, microseconds=-1)
+    return as_of
+
+
+def weekdays_as_of(as_of):
+    """Return the weekday option in effect at as_of."""
+    doc = history_reads.find_one({'kind': 'settings', 'ts': {'$lte': as_of}}, {'weekdays': 1}, sort=[('ts', -1), ('_id', -1)])
+    return _weekdays_from_doc(doc)
+
+
+def classroom_snapshot(classroom, as_of):
+    """Return a classroom's lectures as they were at as_of, sorted by _id."""
+    query = {'kind': 'lecture', 'classroom': classroom, 'ts': {'$lte': as_of}}
+    # the deltas up to as_of are identified by their count and newest _id, which
+    # also changes when a backfill adds deltas dated before later ones
+    found = list(history_reads.aggregate([{'$match': query}, {'$group': {'_id': None, 'n': {'$sum': 1}, 'last': {'$max': '$_id'}}}]))
+    if not found or not found[0]['n']:
+        return []
+    key = (classroom, found[0]['n'], found[0]['last'])
+    with _snapshots_lock:
+        if key in _snapshots:
+            _snapshots.move_to_end(key)
+            return _snapshots[key]
+    state = {}
+    for delta in history_reads.find(query, {'lecture': 1, 'op': 1, 'doc': 1}).sort([('ts', 1), ('_id', 1)]):
+        if delta['op'] == 'delete':
+            state.pop(delta['lecture'], None)
+        else:
+            state[delta['lecture']] = dict(delta['doc'], _id=delta['lecture'])
+    lectures = [lecture_out(state[k]) for k in sorted(state)]
+    with _snapshots_lock:
+        _snapshots[key] = lectures
+        while len(_snapshots) > SNAPSHOT_CACHE_SIZE:
+            _snapshots.popitem(last=False)
+    return lectures
+
+
+# Room capacities. ROOM_CAPACITY ("1:40,2:60") sets them explicitly; other
+# rooms are assumed to hold the largest class they have been booked for.
+ROOM_CAPACITY = {room.strip(): int(cap) for room, _, cap in
+                 (item.partition(':') for item in os.getenv('ROOM_CAPACITY', '').split(',') if ':' in item)}
+_capacity_cache = {}  # classroom -> int or None, dropped by invalidate_classroom
+
+
+def student_count(value):
+    """Return numberOfStudents as an int, or None if it is missing or not a number."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def room_capacity(classroom):
+    """Return the capacity of a classroom, or None if unknown."""
+    if classroom in ROOM_CAPACITY:
+        return ROOM_CAPACITY[classroom]
+    if classroom not in _capacity_cache:
+        counts = [student_count(lec.get('numberOfStudents')) for lec in classroom_lectures(classroom)]
+        _capacity_cache[classroom] = max((c for c in counts if c is not None), default=None)
+    return _capacity_cache[classroom]
+
+
+def free_rooms(days, start, end, min_capacity=None, rooms=None):
+    """Return the rooms with no lecture in [start, end) on any of days.
+
+    Searches CLASSROOMS and every other classroom that has lectures, answered
+    from the per-room minute bitmaps. Rooms of unknown capacity are kept, with
+    capacity None, even when min_capacity is given.
+    """
+    if rooms is None:
+        ensure_all_loaded()
+        rooms = CLASSROOMS + sorted(c for c, ids in list(_by_classroom.items())
+                                    if ids and isinstance(c, str) and c not in CLASSROOMS)
+    else:
+        ensure_classrooms_loaded(rooms)
+    window = minute_bits(start, end)
+    found = []
+    for room in rooms:
+        if any(classroom_index.busy_bits(room, d) & window for d in days):
             continue
-        
-        # overlapping days
-        for d in days:
-            if d in lec_days:
-                # overlapping time
-                if start_min < lec_end_min and lec_start_min < end_min:
-                    return True  # Conflict detected
-    return False  # No conflict
+        capacity = room_capacity(room)
+        if min_capacity is not None and capacity is not None and capacity < min_capacity:
+            continue
+        found.append({'classroom': room, 'capacity': capacity})
+    return found
+
+
+# Bulk import
+IMPORT_FIELDS = ['course', 'instructor', 'days', 'starttime', 'endtime', 'numberOfStudents', 'classroom']
+
+
+def parse_import_rows(data, fmt):
+    """Parse an uploaded CSV or JSON batch into a list of row dicts."""
+    if isinstance(data, bytes):
+        data = data.decode('utf-8-sig')
+    if fmt == 'json':
+        rows = json.loads(data)
+        if isinstance(rows, dict):
+            rows = rows.get('lectures', [])
+        if not isinstance(rows, list):
+            raise ValueError('expected a JSON list of lectures')
+        return rows
+    return list(csv.DictReader(io.StringIO(data)))
+
+
+def import_row_to_lecture(row):
+    """Return (lecture doc, None) for a valid import row, or (None, error message)."""
+    if not isinstance(row, dict):
+        return None, 'row is not an object'
+    for field in ('starttime', 'endtime'):
+        if row.get(field) is not None and not isinstance(row[field], str):
+            return None, f'{field} must be an HH:MM string'
+    if row.get('days') is not None and not isinstance(row['days'], (str, list, tuple)):
+        return None, 'days must be a string or list of day codes'
+    lecture = {}
+    for field in IMPORT_FIELDS:
+        value = row.get(field)
+        lecture[field] = value.strip() if isinstance(value, str) else value
+    days = lecture['days']
+    if isinstance(days, (list, tuple)):
+        days = ''.join(str(d) for d in days)
+    lecture['days'] = ''.join(sorted(set(str(days or '')) & set(DAY_CODES)))
+    if lecture['classroom'] is not None:
+        lecture['classroom'] = str(lecture['classroom'])
+    if not lecture['classroom']:
+        return None, 'classroom required'
+    if not lecture['starttime'] or not lecture['endtime']:
+        return None, 'starttime and endtime required'
+    lecture.update(time_fields(lecture['days'], lecture['starttime'], lecture['endtime']))
+    if lecture['start_min'] is None or lecture['end_min'] is None:
+        return None, 'invalid starttime or endtime'
+    if lecture['start_min'] >= lecture['end_min']:
+        return None, 'endtime must be after starttime'
+    return lecture, None
+
+
+def sweep_keys(lec):
+    """Return the keys a lecture is swept under: its classroom and, if set, its instructor."""
+    keys = [('classroom', lec.get('classroom') or '')]
+    if instructor_key(lec.get('instructor')):
+        keys.append(('instructor', instructor_key(lec.get('instructor'))))
+    return keys
+
+
+def find_overlaps(intervals):
+    """Sweep (key, day, start, end, ref) intervals and return the overlapping ref pairs."""
+    pairs = []
+    active = []  # heap of (end, seq, ref) for the current (key, day)
+    current = None
+    for seq, (key, day, start, end, ref) in enumerate(sorted(intervals, key=lambda iv: (iv[0], iv[1], iv[2], iv[3]))):
+        if (key, day) != current:
+            current = (key, day)
+            active = []
+        while active and active[0][0] <= start:
+            heapq.heappop(active)
+        for _, _, other in active:
+            pairs.append((other, ref))
+        heapq.heappush(active, (end, seq, ref))
+    return pairs
+
+
+def import_lectures(rows, ordered=False):
+    """Validate, conflict-check and insert a batch of lectures.
+
+    Rows are checked against existing lectures and against each other in
+    one sweep per (classroom, day) and (instructor, day). A row that
+    overlaps an existing lecture or an earlier accepted row is reported and
+    skipped; the rest are written with a single insert_many.
+    """
+    results = [{'row': i + 1, 'status': 'ok'} for i in range(len(rows))]
+    docs = {}
+    for i, row in enumerate(rows):
+        lecture, error = import_row_to_lecture(row)
+        if error:
+            results[i].update(status='invalid', error=error)
+        else:
+            docs[i] = lecture
+
+    # existing lectures of the affected classrooms and instructors plus the batch itself
+    existing = {}
+    for classroom in {doc['classroom'] for doc in docs.values()}:
+        existing.update((lec['_id'], lec) for lec in classroom_lectures(classroom))
+    instructors = {instructor_key(doc.get('instructor')) for doc in docs.values()} - {None}
+    if instructors:
+        ensure_all_loaded()
+        with _index_lock:
+            existing.update((i, lec) for i, lec in _lectures.items() if instructor_key(lec.get('instructor')) in instructors)
+    intervals = []
+    for lec_id, lec in existing.items():
+        start, end, mask = lecture_times(lec)
+        if start is not None and end is not None:
+            intervals.extend((key, d, start, end, ('lecture', lec_id)) for key in sweep_keys(lec) for d in mask_to_days(mask))
+    for i, doc in docs.items():
+        intervals.extend((key, d, doc['start_min'], doc['end_min'], ('row', i)) for key in sweep_keys(doc) for d in doc['days'])
+
+    existing_hits = {}
+    row_hits = {}
+    for a, b in find_overlaps(intervals):
+        for this, other in ((a, b), (b, a)):
+            if this[0] != 'row':
+                continue
+            if other[0] == 'lecture':
+                existing_hits.setdefault(this[1], set()).add(other[1])
+            else:
+                row_hits.setdefault(this[1], set()).add(other[1])
+
+    # earlier rows win among overlapping rows of the batch
+    accepted = []
+    for i in sorted(docs):
+        if i in existing_hits:
+            results[i].update(status='conflict', conflicts=[dict(_lectures[x]) for x in sorted(existing_hits[i]) if x in _lectures])
+        elif row_hits.get(i, set()) & set(accepted):
+            results[i].update(status='conflict', conflicting_rows=sorted(j + 1 for j in row_hits[i] & set(accepted)))
+        else:
+            accepted.append(i)
+
+    # claim each row's slots; rows beaten by a concurrent writer are conflicts
+    reserved = []
+    row_of = {}  # str(_id) -> row, for slots held by this batch
+    for i in accepted:
+        docs[i]['_id'] = ObjectId()
+        holders = reserve_slots(docs[i]['_id'], reservation_ids(docs[i]))
+        if holders is None:
+            reserved.append(i)
+            row_of[str(docs[i]['_id'])] = i
+        else:
+            results[i].update(status='conflict', conflicts=find_lectures([h for h in holders if h not in row_of]))
+            if any(h in row_of for h in holders):
+                results[i]['conflicting_rows'] = sorted(row_of[h] + 1 for h in holders if h in row_of)
+    accepted = reserved
+
+    inserted = []
+    if accepted:
+        batch = [docs[i] for i in accepted]
+        try:
+            collection.insert_many(batch, ordered=ordered)
+            inserted = accepted
+        except BulkWriteError as e:
+            failed = {err['index']: err.get('errmsg', 'write error') for err in e.details.get('writeErrors', [])}
+            last = min(failed) if ordered and failed else len(batch)
+            for n, i in enumerate(accepted):
+                if n in failed:
+                    results[i].update(status='error', error=failed[n])
+                elif n > last:
+                    results[i].update(status='skipped', error='not attempted after an earlier write error')
+                else:
+                    inserted.append(i)
+            for i in set(accepted) - set(inserted):
+                release_slots(docs[i]['_id'], reservation_ids(docs[i]))
+        for i in inserted:
+            index_lecture(docs[i], invalidate=False)
+            results[i]['_id'] = str(docs[i]['_id'])
+        record_history([lecture_delta(docs[i]) for i in inserted])
+        invalidate_classroom(*{docs[i]['classroom'] for i in inserted})
+    return {'inserted': len(inserted), 'rows': results}
 #####################################
 
 # Settings helpers
+# Process-local cache of the weekday option. It is refreshed after
+# SETTINGS_TTL seconds, immediately by update_settings, and (when
+# SETTINGS_CHANGE_STREAM is enabled) by a MongoDB change stream so other
+# workers pick up changes without waiting for the TTL. LECTURE_CHANGE_STREAM
+# does the same for the lecture index.
+SETTINGS_TTL = float(os.getenv('SETTINGS_TTL', '60'))
+_settings_cache = {'weekdays': None, 'expires': 0.0}
+
+
+def env_flag_value(value, default=False):
+    """Return True for truthy strings such as '1', 'true', 'yes' or 'on'."""
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def env_flag(name, default=False):
+    """Return True if environment variable name is set to a truthy value."""
+    return env_flag_value(os.getenv(name), default)
+
+
+def _weekdays_from_doc(doc):
+    opt = (doc or {}).get('weekdays', 'sun-thu')
+    return opt if opt in ('sun-thu', 'mon-fri') else 'sun-thu'
+
+
+def cache_weekday_setting(opt):
+    """Store opt in the settings cache, invalidating grids if it changed."""
+    prev = _settings_cache['weekdays']
+    _settings_cache['weekdays'] = opt
+    _settings_cache['expires'] = time.monotonic() + SETTINGS_TTL
+    if prev != opt:
+        invalidate_settings()
+
+
 def get_weekday_setting():
     """Return current weekday option: 'sun-thu' or 'mon-fri'. Defaults to 'sun-thu'."""
+    cached = _settings_cache['weekdays']
+    if cached is not None and time.monotonic() < _settings_cache['expires']:
+        return cached
     if db is None:
         return 'sun-thu'
     try:
-        doc = db.settings.find_one({'_id': 'global'})
-        opt = (doc or {}).get('weekdays', 'sun-thu')
-        return opt if opt in ('sun-thu', 'mon-fri') else 'sun-thu'
+        doc = db.settings.find_one({'_id': 'global'}, {'weekdays': 1})
     except Exception as e:
         logging.warning('Failed to fetch settings: %s', e)
-        return 'sun-thu'
+        return cached or 'sun-thu'
+    opt = _weekdays_from_doc(doc)
+    cache_weekday_setting(opt)
+    return opt
+
+
+def follow_change_stream(coll, pipeline, handler, label):
+    """Feed every change on coll to handler, reconnecting after errors."""
+    while True:
+        try:
+            with coll.watch(pipeline, full_document='updateLookup') as stream:
+                logging.info('Following %s change stream', label)
+                for change in stream:
+                    handler(change)
+        except Exception as e:
+            logging.warning('%s change stream unavailable (%s); retrying later', label, e)
+        time.sleep(max(SETTINGS_TTL, 5))
+
+
+def _apply_settings_change(change):
+    cache_weekday_setting(_weekdays_from_doc(change.get('fullDocument')))
+
+
+def _apply_lecture_change(change):
+    op = change.get('operationType')
+    if op in ('insert', 'update', 'replace') and change.get('fullDocument'):
+        index_lecture(change['fullDocument'])
+    elif op == 'delete':
+        unindex_lecture(str(change['documentKey']['_id']))
+
+
+_watchers = {}  # name -> thread
+
+
+def start_watchers():
+    """Start the change-stream threads enabled by SETTINGS_CHANGE_STREAM / LECTURE_CHANGE_STREAM."""
+    if db is None:
+        return
+    wanted = {
+        'settings': (env_flag('SETTINGS_CHANGE_STREAM'), db.settings, [{'$match': {'documentKey._id': 'global'}}], _apply_settings_change),
+        'lectures': (env_flag('LECTURE_CHANGE_STREAM'), collection, [], _apply_lecture_change),
+    }
+    for name, (enabled, coll, pipeline, handler) in wanted.items():
+        thread = _watchers.get(name)
+        if enabled and (thread is None or not thread.is_alive()):
+            thread = threading.Thread(target=follow_change_stream, args=(coll, pipeline, handler, name),
+                                      name=f'{name}-watcher', daemon=True)
+            thread.start()
+            _watchers[name] = thread
 
-def get_days_config():
+
+def get_days_config(opt=None):
     """Return (days list, day_map dict, rev_map dict) based on settings."""
-    opt = get_weekday_setting()
+    opt = opt or get_weekday_setting()
     if opt == 'mon-fri':
         days = ['MON', 'TUE', 'WED', 'THU', 'FRI']
         day_map = {'1': 'MON', '2': 'TUE', '3': 'WED', '4': 'THU', '5': 'FRI'}
@@ -132,81 +1170,514 @@ def get_days_config():
     rev_map = {v: k for k, v in day_map.items()}
     return days, day_map, rev_map
 
-app = Flask(__name__)
-# Secret key
-app.secret_key = os.getenv('FLASK_SECRET_KEY', 'change-this-secret')
+# Classrooms shown as tabs in base.html
+CLASSROOMS = ['1', '2', '3', '4', '5', '6']
+# Time slots in 24-hour format (internal keys)
+TIMES = ['08', '09', '10', '11', '12', '01', '02', '03', '04', '05', '06', '07']
+# Display times in 12-hour format with AM/PM
+DISPLAY_TIMES = ['8:00 AM', '9:00 AM', '10:00 AM', '11:00 AM', '12:00 PM', '1:00 PM', '2:00 PM', '3:00 PM', '4:00 PM', '5:00 PM', '6:00 PM', '7:00 PM']
 
-@app.route('/',methods=['GET', 'POST'])
-@app.route('/index',methods=['GET', 'POST'])
-def index():
-    """Show classroom schedule."""
-    classroom = request.args.get("classroom")
-    if classroom is None:
-        classroom = "1"  # Default to classroom 1 if not specified
-    
-    # Fetch all lectures for the selected classroom from MongoDB
-    lectures = list(collection.find({"classroom": classroom}))
-    
-    # days/mappings from settings
-    days, day_map, _ = get_days_config()
-    # Time slots in 24-hour format (internal keys)
-    times = ['08', '09', '10', '11', '12', '01', '02', '03', '04', '05', '06', '07']
-    # Display times in 12-hour format with AM/PM
-    display_times = ['8:00 AM', '9:00 AM', '10:00 AM', '11:00 AM', '12:00 PM', '1:00 PM', '2:00 PM', '3:00 PM', '4:00 PM', '5:00 PM', '6:00 PM', '7:00 PM']
-    
+
+def build_schedule(lectures, days, day_map):
+    """Return {day: {time key: 'course - instructor'}} for the given lectures."""
     # empty schedule
-    schedule = {day: {time: '' for time in times} for day in days}
-    
+    schedule = {day: {time: '' for time in TIMES} for day in days}
+
     # fill schedule
     for lecture in lectures:
         course = lecture.get('course', '')
         instructor = lecture.get('instructor', '')
-        days_str = lecture.get('days', '')  # String of day codes (e.g., '123' for SUN,MON,TUE)
-        starttime = lecture.get('starttime', '00:00')
-        endtime = lecture.get('endtime', '00:00')
-        
-        # extract hour
-        start_hour = int(starttime.split(':')[0])
-        end_hour = int(endtime.split(':')[0])
-        
-        # normalize hours
-        if start_hour < 8:
-            start_hour += 12
-        if end_hour < 8:
-            end_hour += 12
-        
+        _, _, mask = lecture_times(lecture)
+        days_str = mask_to_days(mask)  # String of day codes (e.g., '123' for SUN,MON,TUE)
+
         # covered slots
-        time_slots = []
-        for h in range(start_hour, end_hour):
-            if h <= 12:
-                time_slots.append(f"{h:02d}")
-            else:
-                time_slots.append(f"{h-12:02d}")
-        
+        hours = lecture_hours(lecture)
+        if hours is None:
+            logging.warning('Skipping lecture with invalid times in schedule: %r', lecture)
+            continue
+        time_slots = [hour_key(h) for h in hours]
+
         # assign to days/slots
         for d in days_str:
             day_name = day_map.get(d)
             if day_name and day_name in days:
                 for t in time_slots:
-                    if t in times:
+                    if t in TIMES:
                         schedule[day_name][t] = f"{course} - {instructor}"
-    
-    # render
+    return schedule
+
+
+# Built schedule grids keyed by (classroom, weekday option). Entries are
+# dropped by invalidate_classroom whenever a write touches the classroom.
+_grid_cache = {}
+# Last-Modified bookkeeping, in whole seconds like the header. Browsers send
+# If-None-Match alongside If-Modified-Since, so a second change within the
+# same second is still caught by the ETag.
+_started_at = datetime.now(timezone.utc).replace(microsecond=0)
+_modified = {}  # classroom or None (settings) -> datetime
+_page_version = None
+
+
+def _bump_modified(key):
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    _modified[key] = max(now, _modified.get(key, _started_at))
+
+
+def page_version():
+    """Return APP_VERSION, or a hash of the templates and static files, for page ETags.
+
+    A deploy that changes the HTML or its assets then changes every ETag, so
+    browsers do not keep revalidating into a stale page.
+    """
+    global _page_version
+    if _page_version is None:
+        digest = hashlib.sha1(os.getenv('APP_VERSION', '').encode())
+        if not os.getenv('APP_VERSION'):
+            base = os.path.dirname(os.path.abspath(__file__))
+            for folder in ('templates', 'static'):
+                for root, _, files in sorted(os.walk(os.path.join(base, folder))):
+                    for name in sorted(files):
+                        with open(os.path.join(root, name), 'rb') as f:
+                            digest.update(name.encode() + f.read())
+        _page_version = digest.hexdigest()[:12]
+    return _page_version
+
+
+def invalidate_classroom(*classrooms):
+    """Drop cached grids for the given classrooms and wake their event streams."""
+    with _index_lock:
+        for key in [k for k in _grid_cache if k[0] in classrooms]:
+            del _grid_cache[key]
+        for key in [k for k in _export_cache if k[0] in classrooms]:
+            del _export_cache[key]
+        for classroom in classrooms:
+            _capacity_cache.pop(classroom, None)
+            _bump_modified(classroom)
+    notify_subscribers(classrooms)
+
+
+def invalidate_settings():
+    """Mark every grid as modified after a settings change."""
+    with _index_lock:
+        _grid_cache.clear()
+        _export_cache.clear()
+        _bump_modified(None)
+    notify_subscribers(None)
+
+
+# In-process pub/sub for /events. Each stream owns a one-slot queue used as a
+# "something changed" flag; the stream itself diffs the grid it last sent.
+_subscribers = {}  # classroom -> set of queue.Queue
+_subscribers_lock = threading.Lock()
+
+
+def subscribe(classroom):
+    q = queue.Queue(maxsize=1)
+    with _subscribers_lock:
+        _subscribers.setdefault(classroom, set()).add(q)
+    return q
+
+
+def unsubscribe(classroom, q):
+    with _subscribers_lock:
+        queues = _subscribers.get(classroom, set())
+        queues.discard(q)
+        if not queues:
+            _subscribers.pop(classroom, None)
+
+
+def notify_subscribers(classrooms):
+    """Wake the event streams of classrooms (all streams if None)."""
+    with _subscribers_lock:
+        if classrooms is None:
+            queues = [q for qs in _subscribers.values() for q in qs]
+        else:
+            queues = [q for c in classrooms for q in _subscribers.get(c, ())]
+    for q in queues:
+        try:
+            q.put_nowait(True)
+        except queue.Full:
+            pass
+
+
+def get_grid(classroom, opt=None):
+    """Return the cached grid entry for a classroom, building it on a miss."""
+    opt = opt or get_weekday_setting()
+    sync_classrooms([classroom])
+    key = (classroom, opt)
+    entry = _grid_cache.get(key)
+    if entry is not None:
+        return entry
+    with _index_lock:
+        days, day_map, _ = get_days_config(opt)
+        schedule = build_schedule(classroom_lectures(classroom), days, day_map)
+        digest = hashlib.sha1(json.dumps([page_version(), opt, schedule], sort_keys=True).encode()).hexdigest()
+        entry = {
+            'days': days,
+            'day_map': day_map,
+            'schedule': schedule,
+            'etag': digest,
+            'last_modified': max(_modified.get(classroom, _started_at), _modified.get(None, _started_at)),
+        }
+        if known_classroom(classroom):
+            _grid_cache[key] = entry
+    return entry
+
+def stream_response(chunks, mimetype):
+    """Stream string chunks, gzip-compressed when the client accepts it."""
+    gzip_ok = 'gzip' in request.accept_encodings
+
+    def generate():
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip_ok else None
+        for chunk in chunks:
+            data = chunk.encode()
+            if compressor:
+                data = compressor.compress(data)
+            if data:
+                yield data
+        if compressor:
+            yield compressor.flush()
+
+    resp = Response(generate(), mimetype=mimetype)
+    resp.vary.add('Accept-Encoding')
+    if gzip_ok:
+        resp.headers['Content-Encoding'] = 'gzip'
+    return resp
+
+
+# Calendar/CSV exports. Each file is named by a hash of everything it is
+# rendered from and kept in EXPORT_CACHE_DIR, so calendar polls are served
+# from disk (or 304) and a file is only re-rendered after its classroom or
+# the settings change.
+EXPORT_CACHE_DIR = os.getenv('EXPORT_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'labs-export')
+EXPORT_FORMATS = {'ics': 'text/calendar', 'csv': 'text/csv'}
+EXPORT_CSV_FIELDS = ['course', 'instructor', 'days', 'starttime', 'endtime', 'numberOfStudents', 'classroom']
+ICAL_DAYS = {'SUN': 'SU', 'MON': 'MO', 'TUE': 'TU', 'WED': 'WE', 'THU': 'TH', 'FRI': 'FR', 'SAT': 'SA'}
+_export_cache = {}  # (classroom, fmt) -> {'path', 'etag'}, dropped by invalidate_classroom
+
+
+def term_dates():
+    """Return (first day, last day or None) of the term from TERM_START/TERM_END (YYYY-MM-DD).
+
+    Without TERM_START recurrences start in the current week.
+    """
+    start = os.getenv('TERM_START')
+    end = os.getenv('TERM_END')
+    first = date.fromisoformat(start) if start else date.today() - timedelta(days=(date.today().weekday() + 1) % 7)
+    return first, date.fromisoformat(end) if end else None
+
+
+def ical_text(value):
+    """Escape a value for an iCalendar TEXT property."""
+    return str(value or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def ical_fold(line):
+    """Fold a content line at 75 octets as RFC 5545 requires."""
+    data = line.encode()
+    parts = []
+    while len(data) > 75:
+        cut = 75 if not parts else 74
+        # do not split a UTF-8 sequence
+        while cut and (data[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(data[:cut])
+        data = data[cut:]
+    parts.append(data)
+    return b'\r\n '.join(parts).decode()
+
+
+def render_ics(classroom, lectures, day_map):
+    """Return an iCalendar file with one weekly recurring event per lecture."""
+    first, last = term_dates()
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//labs//classroom schedule//EN', 'CALSCALE:GREGORIAN',
+             f'X-WR-CALNAME:{ical_text(f"Classroom {classroom}")}']
+    for lec in lectures:
+        start, end, mask = lecture_times(lec)
+        byday = [ICAL_DAYS[day_map[d]] for d in mask_to_days(mask)]
+        if start is None or end is None or not byday:
+            continue
+        # first occurrence on or after the term start
+        offsets = [(list(ICAL_DAYS.values()).index(d) - (first.weekday() + 1) % 7) % 7 for d in byday]
+        day = first + timedelta(days=min(offsets))
+        rrule = f"FREQ=WEEKLY;BYDAY={','.join(byday)}"
+        if last:
+            rrule += f";UNTIL={last.strftime('%Y%m%d')}T235959"
+        description = f"Instructor: {lec.get('instructor') or ''}"
+        if lec.get('numberOfStudents'):
+            description += f"\nStudents: {lec['numberOfStudents']}"
+        lines += [
+            'BEGIN:VEVENT',
+            f"UID:{lec['_id']}@labs",
+            f'DTSTAMP:{stamp}',
+            f"DTSTART:{day.strftime('%Y%m%d')}T{start // 60:02d}{start % 60:02d}00",
+            f"DTEND:{day.strftime('%Y%m%d')}T{end // 60:02d}{end % 60:02d}00",
+            f'RRULE:{rrule}',
+            f"SUMMARY:{ical_text(lec.get('course'))}",
+            f'DESCRIPTION:{ical_text(description)}',
+            f"LOCATION:{ical_text(f'Classroom {classroom}')}",
+            'END:VEVENT',
+        ]
+    lines.append('END:VCALENDAR')
+    return ''.join(ical_fold(line) + '\r\n' for line in lines)
+
+
+def render_csv(lectures, day_map):
+    """Return the lectures as CSV with day names and 24-hour times."""
+    out = io.StringIO()
+    writer = csv.DictWriter(out, EXPORT_CSV_FIELDS, extrasaction='ignore')
+    writer.writeheader()
+    for lec in lectures:
+        start, end, mask = lecture_times(lec)
+        writer.writerow(dict(lec, days=' '.join(day_map[d] for d in mask_to_days(mask)),
+                             starttime=format_minutes(start) if start is not None else lec.get('starttime'),
+                             endtime=format_minutes(end) if end is not None else lec.get('endtime')))
+    return out.getvalue()
+
+
+def export_file(classroom, fmt):
+    """Return the cache entry for a classroom export, rendering it on a miss."""
+    sync_classrooms([classroom])
+    entry = _export_cache.get((classroom, fmt))
+    # another worker may have removed the file when it rendered a newer one
+    if entry is not None and os.path.exists(entry['path']):
+        return entry
+    opt = get_weekday_setting()
+    _, day_map, _ = get_days_config(opt)
+    with _index_lock:
+        lectures = sorted(classroom_lectures(classroom), key=lambda lec: (lecture_times(lec)[0] or 0, lec['_id']))
+    first, last = term_dates()
+    digest = hashlib.sha1(json.dumps([fmt, opt, str(first), str(last), lectures], sort_keys=True, default=str).encode()).hexdigest()
+    path = os.path.join(EXPORT_CACHE_DIR, f'{classroom}-{digest}.{fmt}')
+    if not os.path.exists(path):
+        body = render_ics(classroom, lectures, day_map) if fmt == 'ics' else render_csv(lectures, day_map)
+        os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+        # write then rename so concurrent readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=EXPORT_CACHE_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'w', newline='') as f:
+            f.write(body)
+        os.replace(tmp, path)
+        for name in os.listdir(EXPORT_CACHE_DIR):
+            if name.startswith(f'{classroom}-') and name.endswith(f'.{fmt}') and name != os.path.basename(path):
+                try:
+                    os.remove(os.path.join(EXPORT_CACHE_DIR, name))
+                except OSError:
+                    pass
+    entry = _export_cache[(classroom, fmt)] = {'path': path, 'etag': digest}
+    return entry
+
+
+# Static assets are linked as /static/<file>?v=<content hash>, so a changed
+# file gets a new URL and browsers may keep each version for a year.
+STATIC_MAX_AGE = 365 * 24 * 3600
+_static_versions = {}  # filename -> content hash
+
+
+def static_url(filename):
+    """Return the fingerprinted URL of a file under static/."""
+    version = _static_versions.get(filename)
+    if version is None or current_app.debug:
+        with open(os.path.join(current_app.static_folder, filename), 'rb') as f:
+            version = _static_versions[filename] = hashlib.md5(f.read()).hexdigest()[:12]
+    return url_for('static', filename=filename, v=version)
+
+
+def static_cache_headers(response):
+    """Mark fingerprinted static files as cacheable for STATIC_MAX_AGE."""
+    if request.endpoint == 'static' and request.args.get('v') and response.status_code in (200, 304):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+        response.cache_control.immutable = True
+    return response
+
+
+# gzip for buffered text responses (streamed ones compress themselves)
+COMPRESS_RESPONSES = env_flag('COMPRESS_RESPONSES', True)
+COMPRESS_MIN_SIZE = 500
+COMPRESS_MIMETYPES = {'text/html', 'text/css', 'text/plain', 'text/csv', 'text/calendar', 'text/javascript',
+                      'application/javascript', 'application/json'}
+
+
+def compress_response(response):
+    """Gzip a buffered response when the client accepts it."""
+    if (not COMPRESS_RESPONSES or response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    if 'gzip' not in request.accept_encodings:
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = 'gzip'
+    # the bytes differ from the identity encoding, so the tag can only be weak
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+# Password hashing
+# KDF calls run in a small bounded pool. The request thread still waits for
+# the result, so the pool does not free web threads; it caps how many KDFs
+# burn CPU and memory at once. Once PASSWORD_HASH_QUEUE calls are waiting
+# behind the pool, further logins get a 503 instead of queueing too.
+# Plaintext passwords from older databases are accepted once and rehashed in
+# the background.
+PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'scrypt')
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', '2'))
+PASSWORD_HASH_QUEUE = int(os.getenv('PASSWORD_HASH_QUEUE', '8'))
+_kdf_pool = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix='kdf')
+_kdf_slots = threading.BoundedSemaphore(PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE)
+HASH_PREFIXES = ('scrypt:', 'pbkdf2:')
+
+
+class PasswordHashBusy(Exception):
+    """The KDF pool and its queue are full."""
+
+
+def run_kdf(func, *args, **kwargs):
+    """Run a KDF call on the pool and wait for it; raise PasswordHashBusy if the queue is full."""
+    if not _kdf_slots.acquire(blocking=False):
+        raise PasswordHashBusy()
+    try:
+        return _kdf_pool.submit(func, *args, **kwargs).result()
+    finally:
+        _kdf_slots.release()
+
+
+def hash_password(password):
+    """Hash password with the configured method on the KDF pool."""
+    return run_kdf(generate_password_hash, password, method=PASSWORD_HASH_METHOD)
+
+
+def verify_password(stored, password):
+    """Return (matches, needs_rehash) for a stored hash or legacy plaintext password."""
+    if not stored or not password:
+        return False, False
+    if stored.startswith(HASH_PREFIXES):
+        ok = run_kdf(check_password_hash, stored, password)
+        return ok, ok and not stored.startswith(PASSWORD_HASH_METHOD.split(':')[0] + ':')
+    ok = hmac.compare_digest(stored.encode(), password.encode())
+    return ok, ok
+
+
+def _rehash_password(username, stored, password):
+    try:
+        # only replace the exact value we verified against
+        db.users.update_one({'username': username, 'password': stored},
+                            {'$set': {'password': generate_password_hash(password, method=PASSWORD_HASH_METHOD)}})
+    except Exception as e:
+        logging.warning('Could not upgrade password hash for %s: %s', username, e)
+
+
+def upgrade_password_later(username, stored, password):
+    """Rehash a legacy or outdated password on the KDF pool without waiting.
+
+    Skipped while the pool is busy; the next login tries again.
+    """
+    if _kdf_slots.acquire(blocking=False):
+        _kdf_pool.submit(_rehash_password, username, stored, password).add_done_callback(lambda _: _kdf_slots.release())
+
+
+# Short-lived cache of user role documents for authenticated write routes
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '30'))
+_user_cache = {}  # username -> (expires, doc or None)
+
+
+def get_user(username):
+    """Return {'username', 'role'} for username (None if unknown), cached for USER_CACHE_TTL."""
+    if not username or db is None:
+        return None
+    hit = _user_cache.get(username)
+    if hit is not None and time.monotonic() < hit[0]:
+        return hit[1]
+    try:
+        doc = db.users.find_one({'username': username}, {'_id': 0, 'username': 1, 'role': 1})
+    except Exception as e:
+        logging.warning('Failed to fetch user %s: %s', username, e)
+        return hit[1] if hit else None
+    _user_cache[username] = (time.monotonic() + USER_CACHE_TTL, doc)
+    return doc
+
+
+def current_user():
+    """Return the logged-in user's cached role document, or None."""
+    return get_user(session.get('user'))
+
+
+bp = Blueprint('main', __name__, cli_group=None)
+
+
+@bp.errorhandler(PasswordHashBusy)
+def password_hash_busy(e):
+    """Ask the client to retry when too many password checks are queued."""
+    return 'Too many sign-ins in progress; please try again in a moment', 503, {'Retry-After': '2'}
+
+
+@bp.route('/',methods=['GET', 'POST'])
+@bp.route('/index',methods=['GET', 'POST'])
+def index():
+    """Show classroom schedule."""
+    classroom = request.args.get("classroom")
+    if classroom is None:
+        classroom = "1"  # Default to classroom 1 if not specified
+
+    # archived view, read-only and rebuilt from the history
+    as_of = request.args.get('as_of')
+    if as_of:
+        try:
+            when = parse_as_of(as_of)
+        except ValueError:
+            return 'Invalid as_of (use YYYY-MM-DD or an ISO datetime)', 400
+        days, day_map, _ = get_days_config(weekdays_as_of(when))
+        schedule = build_schedule(classroom_snapshot(classroom, when), days, day_map)
+        resp = make_response(render_template('index.html', classroom=classroom, days=days, day_map=day_map, times=TIMES, display_times=DISPLAY_TIMES, schedule=schedule, grid_etag='', as_of=as_of, show_classroom_tabs=True, is_logged_in=False))
+        resp.headers['Cache-Control'] = 'private, no-cache'
+        return resp
+
+    # cached grid for this classroom and weekday option
+    grid = get_grid(classroom)
     is_logged_in = bool(session.get('user'))
-    return render_template('index.html', classroom=classroom, days=days, day_map=day_map, times=times, display_times=display_times, schedule=schedule, show_classroom_tabs=True, is_logged_in=is_logged_in)
+    # the page also varies with the logged-in user
+    etag = hashlib.sha1(f"{grid['etag']}:{session.get('user') or ''}".encode()).hexdigest()
+
+    # conditional GET
+    if request.method in ('GET', 'HEAD'):
+        if request.if_none_match:
+            # weak comparison: gzip-encoded pages carry W/ tags
+            not_modified = request.if_none_match.contains_weak(etag)
+        else:
+            not_modified = bool(request.if_modified_since and request.if_modified_since >= grid['last_modified'])
+        if not_modified:
+            resp = make_response('', 304)
+            resp.set_etag(etag)
+            resp.headers['Cache-Control'] = 'private, no-cache'
+            return resp
+
+    # render
+    resp = make_response(render_template('index.html', classroom=classroom, days=grid['days'], day_map=grid['day_map'], times=TIMES, display_times=DISPLAY_TIMES, schedule=grid['schedule'], grid_etag=grid['etag'], live_updates=LIVE_UPDATES, poll_seconds=LIVE_POLL_SECONDS, show_classroom_tabs=True, is_logged_in=is_logged_in))
+    resp.set_etag(etag)
+    resp.last_modified = grid['last_modified']
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    resp.vary.add('Cookie')
+    return resp
 
-@app.route('/cpanel')
+@bp.route('/cpanel')
 def process():
     """Control panel."""
     # Provide current weekday option to cpanel
     return render_template('cpanel.html', show_classroom_tabs=False, weekday_option=get_weekday_setting())
 
 
-@app.route('/change_password', methods=['POST'])
+@bp.route('/change_password', methods=['POST'])
 def change_password():
     """Change password."""
     if not session.get('user'):
-        return redirect(url_for('login', next=url_for('process')))
+        return redirect(url_for('.login', next=url_for('.process')))
 
     username = session.get('user')
     current = request.form.get('current_password')
@@ -221,26 +1692,27 @@ def change_password():
         return render_template('cpanel.html', show_classroom_tabs=False, error='Database not configured')
 
     try:
-        user_doc = db.users.find_one({'username': username})
+        user_doc = db.users.find_one({'username': username}, {'password': 1})
     except Exception as e:
         logging.error('DB error fetching user: %s', e)
         return render_template('cpanel.html', show_classroom_tabs=False, error='Database error')
 
     if not user_doc:
         return render_template('cpanel.html', show_classroom_tabs=False, error='User not found')
-    if user_doc.get('password') != current:
+    if not verify_password(user_doc.get('password'), current)[0]:
         return render_template('cpanel.html', show_classroom_tabs=False, error='Current password incorrect')
 
-    # update password (note: plaintext storage—consider hashing in future)
+    # update password; hashing stays outside the try so PasswordHashBusy reaches its 503 handler
+    hashed = hash_password(new)
     try:
-        db.users.update_one({'username': username}, {'$set': {'password': new}})
+        db.users.update_one({'username': username}, {'$set': {'password': hashed}})
         return render_template('cpanel.html', show_classroom_tabs=False, success='Password updated successfully')
     except Exception as e:
         logging.error('DB error updating password: %s', e)
         return render_template('cpanel.html', show_classroom_tabs=False, error='Failed to update password')
 
 
-@app.route('/get_lecture')
+@bp.route('/get_lecture')
 def get_lecture():
     """Return lecture covering classroom/day/time."""
     classroom = request.args.get('classroom')
@@ -255,68 +1727,332 @@ def get_lecture():
     if not day_code:
         return jsonify({})
 
-    # convert time key to minutes for comparison
+    # normalize requested time key to comparable hour
     try:
-        t_h = int(time_key)
+        req_h = normalize_hour(int(time_key))
     except Exception:
         return jsonify({})
 
-    # Find candidate lectures in this classroom that include the day
-    candidates = list(collection.find({"classroom": classroom}))
-    for lec in candidates:
-        days = lec.get('days', '')
-        if day_code in days:
-            start = lec.get('starttime', '00:00')
-            end = lec.get('endtime', '00:00')
-            try:
-                s_h = int(start.split(':')[0])
-                e_h = int(end.split(':')[0])
-                # normalize PM times (same heuristic as index)
-                if s_h < 8:
-                    s_h += 12
-                if e_h < 8:
-                    e_h += 12
-                # normalize requested time key to comparable hour
-                req_h = t_h
-                if req_h < 8:
-                    req_h += 12
-                # check range
-                if s_h <= req_h < e_h:
-                    # prepare jsonable doc
-                    lec_out = {k: v for k, v in lec.items() if k != '_id'}
-                    lec_out['_id'] = str(lec['_id'])
-                    return jsonify(lec_out)
-            except Exception:
-                continue
-    return jsonify({})
+    return jsonify(lookup_cell(classroom, day_code, req_h) or {})
+
+
+@bp.route('/get_lectures')
+def get_lectures():
+    """Return lectures for many cells: ?classroom=N&cell=SUN:08&cell=MON:09 (JSON)."""
+    classroom = request.args.get('classroom')
+    cells = [c for arg in request.args.getlist('cell') for c in arg.split(',') if c]
+    if not classroom or not cells:
+        return jsonify({'lectures': {}})
+
+    _, _, rev_map = get_days_config()
+    out = {}
+    for cell in cells:
+        day, _, time_key = cell.partition(':')
+        day_code = rev_map.get(day)
+        try:
+            req_h = normalize_hour(int(time_key))
+        except Exception:
+            day_code = None
+        out[cell] = (lookup_cell(classroom, day_code, req_h) or {}) if day_code else {}
+    return jsonify({'lectures': out})
+
+
+@bp.route('/free_rooms')
+def free_rooms_route():
+    """Return free classrooms: ?days=SUN,TUE&starttime=10:00&endtime=11:30&capacity=40 (JSON)."""
+    _, _, rev_map = get_days_config()
+    days = ''
+    for day in (request.args.get('days') or '').replace(',', ' ').split():
+        code = rev_map.get(day.upper())
+        if code:
+            days += code
+        elif set(day) <= set(DAY_CODES):
+            days += day
+        else:
+            return jsonify({'error': f'invalid day {day!r}'}), 400
+    start = normalize_minutes(request.args.get('starttime'))
+    end = normalize_minutes(request.args.get('endtime'))
+    if not days or start is None or end is None or start >= end:
+        return jsonify({'error': 'days, starttime and endtime (HH:MM, end after start) are required'}), 400
+    capacity = request.args.get('capacity')
+    if capacity and student_count(capacity) is None:
+        return jsonify({'error': 'invalid capacity'}), 400
+    rooms = free_rooms(sorted(set(days)), start, end, student_count(capacity))
+    return jsonify({'rooms': rooms})
+
 
+# Seconds /healthz waits for MongoDB
+HEALTH_TIMEOUT = float(os.getenv('HEALTH_TIMEOUT', '2'))
 
-@app.route('/lectures')
+
+@bp.route('/healthz')
+def healthz():
+    """Readiness probe: 200 once MongoDB answers and the database is bootstrapped, else 503 (JSON)."""
+    status = {'mongo': False, 'bootstrapped': _db_initialized}
+    try:
+        with pymongo.timeout(HEALTH_TIMEOUT):
+            ensure_db()
+            if client is not None:
+                client.admin.command('ping')
+                status['mongo'] = True
+    except Exception as e:
+        logging.warning('Health check failed: %s', e)
+        status['error'] = type(e).__name__
+    status['bootstrapped'] = _db_initialized
+    ready = status['mongo'] and (_db_initialized or not env_flag('DB_BOOTSTRAP', True))
+    status['status'] = 'ok' if ready else 'unavailable'
+    return jsonify(status), 200 if ready else 503
+
+
+@bp.route('/conflicts')
+def conflicts_report():
+    """Audit the whole timetable for classroom and instructor double-bookings (JSON)."""
+    if collection is None:
+        return jsonify({'error': 'Database not configured'}), 500
+    return jsonify(timetable_conflicts())
+
+
+@bp.route('/export/<classroom>.<any(ics, csv):fmt>')
+def export_schedule(classroom, fmt):
+    """Download a classroom's timetable as iCalendar or CSV."""
+    if not classroom.isalnum():
+        abort(404)
+    ensure_classroom_loaded(classroom)
+    if not known_classroom(classroom):
+        abort(404)
+    for attempt in range(2):
+        entry = export_file(classroom, fmt)
+        try:
+            resp = send_file(entry['path'], mimetype=EXPORT_FORMATS[fmt], as_attachment=fmt == 'csv',
+                             download_name=f'classroom-{classroom}.{fmt}', etag=entry['etag'], conditional=True)
+            break
+        except FileNotFoundError:
+            # removed by another worker between the check and the open; render it again
+            if attempt:
+                raise
+    resp.headers['Cache-Control'] = 'public, no-cache'
+    return resp
+
+
+# /lectures JSON page size without ?limit, and the largest page allowed;
+# only the NDJSON stream returns every match when no limit is given
+LECTURES_PAGE_SIZE = 100
+LECTURES_MAX_PAGE_SIZE = 1000
+
+
+@bp.route('/lectures')
 def lectures_for_classroom():
-    """List lectures for a classroom (JSON)."""
+    """List lectures for a classroom (JSON pages keyed on _id, or NDJSON stream).
+
+    Query parameters: classroom (required), instructor, course, day (code or
+    name), fields (comma-separated), limit (page size, default
+    LECTURES_PAGE_SIZE; NDJSON streams every match without it), after (_id of
+    the last lecture of the previous page), format=ndjson, as_of (date or ISO
+    datetime; lists the classroom as it was then).
+    """
     classroom = request.args.get('classroom')
+    ndjson = request.args.get('format') == 'ndjson' or request.accept_mimetypes.best == 'application/x-ndjson'
     if not classroom:
-        return jsonify({'lectures': []})
-    docs = list(collection.find({'classroom': classroom}))
-    out = []
-    for d in docs:
-        o = {k: v for k, v in d.items() if k != '_id'}
-        o['_id'] = str(d['_id'])
-        out.append(o)
-    return jsonify({'lectures': out})
+        return jsonify({'lectures': [], 'next': None})
+
+    when = None
+    if request.args.get('as_of'):
+        try:
+            when = parse_as_of(request.args['as_of'])
+        except ValueError:
+            return jsonify({'error': 'invalid as_of'}), 400
+
+    query = {'classroom': classroom}
+    for field in ('instructor', 'course'):
+        if request.args.get(field):
+            query[field] = request.args[field]
+    day = request.args.get('day')
+    code = None
+    if day:
+        _, _, rev_map = get_days_config(weekdays_as_of(when) if when else None)
+        code = rev_map.get(day.upper(), day)
+        if code not in DAY_CODES:
+            return jsonify({'error': 'invalid day'}), 400
+        # documents written before migrate-times have no day_mask yet
+        query['$or'] = [{'day_mask': {'$bitsAllSet': days_to_mask(code)}},
+                        {'day_mask': {'$exists': False}, 'days': {'$regex': code}}]
+    after = request.args.get('after')
+    if after:
+        try:
+            query['_id'] = {'$gt': ObjectId(after)}
+        except Exception:
+            return jsonify({'error': 'invalid after cursor'}), 400
+
+    projection = LECTURE_FIELDS
+    fields = [f for f in (request.args.get('fields') or '').split(',') if f in LECTURE_FIELDS]
+    if fields:
+        projection = {f: 1 for f in fields}
+
+    try:
+        limit = int(request.args['limit']) if request.args.get('limit') else None
+    except ValueError:
+        return jsonify({'error': 'invalid limit'}), 400
+    if limit is not None:
+        limit = max(1, min(limit, LECTURES_MAX_PAGE_SIZE))
+
+    if when:
+        # the same filters, applied to the cached snapshot (sorted by _id)
+        docs = [{k: v for k, v in lec.items() if k in projection or k == '_id'} for lec in classroom_snapshot(classroom, when)
+                if all(lec.get(f) == query[f] for f in ('instructor', 'course') if f in query)
+                and (not code or code in mask_to_days(lecture_times(lec)[2]))
+                and (not after or lec['_id'] > after)]
+        if ndjson:
+            return stream_response((json.dumps(d) + '\n' for d in (docs[:limit] if limit else docs)), 'application/x-ndjson')
+        limit = limit or LECTURES_PAGE_SIZE
+        next_after = docs[limit - 1]['_id'] if len(docs) > limit else None
+        return jsonify({'lectures': docs[:limit], 'next': next_after})
+
+    cursor = schedule_reads.find(query, projection).sort('_id', 1)
+    if ndjson:
+        # exports stream every match unless a limit is given
+        if limit:
+            cursor = cursor.limit(limit)
+        return stream_response((json.dumps(lecture_out(d)) + '\n' for d in cursor), 'application/x-ndjson')
+
+    limit = limit or LECTURES_PAGE_SIZE
+    docs = [lecture_out(d) for d in cursor.limit(limit + 1)]
+    next_after = docs[limit - 1]['_id'] if len(docs) > limit else None
+    return jsonify({'lectures': docs[:limit], 'next': next_after})
+
+
+@bp.route('/schedule')
+def schedule_all():
+    """Grids for every classroom, or ?classroom=1,2 (streamed JSON; a single classroom supports If-None-Match)."""
+    requested = [c for arg in request.args.getlist('classroom') for c in arg.split(',') if c]
+    opt = get_weekday_setting()
+    days, day_map, _ = get_days_config(opt)
+    wanted = requested or CLASSROOMS
+
+    if len(requested) == 1:
+        # one classroom (what open schedule pages poll): answer from its cached grid
+        grid = get_grid(requested[0], opt)
+        if request.if_none_match.contains_weak(grid['etag']):
+            resp = make_response('', 304)
+        else:
+            resp = make_response(json.dumps({'weekdays': opt, 'days': days, 'times': TIMES, 'display_times': DISPLAY_TIMES,
+                                             'classrooms': {requested[0]: grid['schedule']}}))
+            resp.mimetype = 'application/json'
+        resp.set_etag(grid['etag'])
+        resp.headers['Cache-Control'] = 'no-cache'
+        return resp
+
+    sync_classrooms(wanted)
+
+    # cached grids first; everything else comes from one aggregation
+    cached = {}
+    for c in wanted:
+        entry = _grid_cache.get((c, opt))
+        if entry is not None:
+            cached[c] = entry['schedule']
+    if requested:
+        missing = [c for c in requested if c not in cached]
+        match = {'classroom': {'$in': missing}} if missing else None
+    else:
+        match = {'classroom': {'$nin': list(cached)}}
+    pipeline = [
+        {'$match': match},
+        {'$project': LECTURE_FIELDS},
+        {'$group': {'_id': '$classroom', 'lectures': {'$push': '$$ROOT'}}},
+    ]
+
+    def chunks():
+        # header fields, leaving the top-level object open for the grids
+        header = json.dumps({'weekdays': opt, 'days': days, 'times': TIMES, 'display_times': DISPLAY_TIMES})
+        yield header[:-1] + ', "classrooms": {'
+        sent = []
+        for c, schedule in cached.items():
+            yield ('' if not sent else ', ') + json.dumps(c) + ': ' + json.dumps(schedule)
+            sent.append(c)
+        if match is not None and schedule_reads is not None:
+            for group in schedule_reads.aggregate(pipeline):
+                c = group['_id']
+                # lectures without a classroom cannot be a JSON object key
+                if c in sent or not isinstance(c, str):
+                    continue
+                yield ('' if not sent else ', ') + json.dumps(c) + ': ' + json.dumps(build_schedule(group['lectures'], days, day_map))
+                sent.append(c)
+        # classrooms without lectures still get an empty grid
+        empty = build_schedule([], days, day_map)
+        for c in wanted:
+            if c not in sent:
+                yield ('' if not sent else ', ') + json.dumps(c) + ': ' + json.dumps(empty)
+                sent.append(c)
+        yield '}}'
+
+    return stream_response(chunks(), 'application/json')
+
+
+# How open schedule pages follow changes: 'off' (the default) leaves them as
+# loaded; 'poll' re-reads the classroom from /schedule every
+# LIVE_POLL_SECONDS, which costs a 304 while the grid is unchanged; 'sse'
+# keeps an /events stream open, which holds a worker thread per open page for
+# up to SSE_MAX_SECONDS, so only enable it with threads to spare.
+LIVE_UPDATES = os.getenv('LIVE_UPDATES', 'off')
+LIVE_POLL_SECONDS = int(os.getenv('LIVE_POLL_SECONDS', '30'))
+# Event streams are closed after this long so threads recycle; browsers reconnect
+SSE_MAX_SECONDS = float(os.getenv('SSE_MAX_SECONDS', '300'))
+SSE_HEARTBEAT_SECONDS = 15
+
+
+@bp.route('/events')
+def events():
+    """Server-sent events: changed cells of ?classroom=N as they are written (LIVE_UPDATES=sse)."""
+    if LIVE_UPDATES != 'sse':
+        abort(404)
+    classroom = request.args.get('classroom') or '1'
+    client_etag = request.args.get('etag')
+    q = subscribe(classroom)
+
+    def changed_cells(old, new):
+        return [{'day': day, 'time': t, 'text': text}
+                for day, slots in new['schedule'].items()
+                for t, text in slots.items()
+                if old is None or old['schedule'].get(day, {}).get(t) != text]
+
+    def stream():
+        deadline = time.monotonic() + SSE_MAX_SECONDS
+        try:
+            yield 'retry: 5000\n\n'
+            last = get_grid(classroom)
+            if client_etag and client_etag != last['etag']:
+                # the page was rendered before a change we have already seen
+                yield f"event: cells\ndata: {json.dumps(changed_cells(None, last))}\n\n"
+            while time.monotonic() < deadline:
+                try:
+                    q.get(timeout=SSE_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                # also picks up writes made by other worker processes
+                grid = get_grid(classroom)
+                if grid['days'] != last['days']:
+                    yield 'event: reload\ndata: {}\n\n'
+                    return
+                cells = changed_cells(last, grid)
+                if cells:
+                    yield f"event: cells\ndata: {json.dumps(cells)}\n\n"
+                last = grid
+        finally:
+            unsubscribe(classroom, q)
 
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
-@app.route('/update_lecture', methods=['GET', 'POST'])
+
+@bp.route('/update_lecture', methods=['GET', 'POST'])
 def update_lecture():
     """Update a lecture by id."""
     if collection is None:
         return 'Database not configured', 500
 
     # require login
-    if not session.get('user'):
+    if not current_user():
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
             return jsonify({'success': False, 'error': 'unauthorized'}), 401
-        return redirect(url_for('login', next=request.path))
+        return redirect(url_for('.login', next=request.path))
 
     lec_id = request.args.get('id') or request.form.get('id')
     if not lec_id:
@@ -341,6 +2077,10 @@ def update_lecture():
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
             return jsonify({'success': False, 'error': 'starttime and endtime required'}), 400
         return 'starttime and endtime required', 400
+    if not classroom:
+        if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+            return jsonify({'success': False, 'error': 'classroom required'}), 400
+        return 'classroom required', 400
 
     update = {
         'course': course,
@@ -351,7 +2091,38 @@ def update_lecture():
         'classroom': classroom,
         'instructor': instructor,
     }
-    collection.update_one({'_id': oid}, {'$set': update})
+    update.update(time_fields(days, starttime, endtime))
+
+    old = collection.find_one({'_id': oid}, LECTURE_FIELDS)
+    if old is None:
+        if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+            return jsonify({'success': False, 'error': 'not found'}), 404
+        return 'Lecture not found', 404
+    resp = check_conflicts(update, exclude_id=lec_id)
+    if resp:
+        return resp
+
+    # claim only the slots the lecture does not hold yet
+    old_slots = set(reservation_ids(old))
+    new_slots = set(reservation_ids(update))
+    gained = sorted(new_slots - old_slots)
+    holders = reserve_slots(oid, gained)
+    if holders is not None:
+        return conflict_response('conflict', 'Time slot was just booked by another lecture', find_lectures(holders))
+    # version-stamped write: a concurrent edit of the same lecture makes this one fail
+    result = collection.update_one({'_id': oid, 'version': old.get('version')}, {'$set': update, '$inc': {'version': 1}})
+    if not result.matched_count:
+        release_slots(oid, gained)
+        if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+            return jsonify({'success': False, 'error': 'modified concurrently'}), 409
+        return 'Lecture was modified by someone else; reload and try again', 409
+    release_slots(oid, old_slots - new_slots)
+    update['version'] = (old.get('version') or 0) + 1
+    index_lecture(dict(update, _id=oid))
+    deltas = [lecture_delta(dict(update, _id=oid))]
+    if old.get('classroom') != classroom:
+        deltas.append(lecture_delta(old, 'delete'))
+    record_history(deltas)
     # AJAX response
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
         update_out = update.copy()
@@ -365,30 +2136,32 @@ def update_lecture():
         target_classroom = '1'
     return redirect(f"/index?classroom={target_classroom}")
 
-@app.route('/about')
+@bp.route('/about')
 def about():
     """About page."""
     return render_template('about.html', show_classroom_tabs=False)
 
 
-@app.route('/update_settings', methods=['POST'])
+@bp.route('/update_settings', methods=['POST'])
 def update_settings():
     """Update global weekday option (requires login)."""
-    if not session.get('user'):
-        return redirect(url_for('login', next=url_for('process')))
+    if not current_user():
+        return redirect(url_for('.login', next=url_for('.process')))
 
     option = request.form.get('weekday_option')
     if option not in ('sun-thu', 'mon-fri'):
         return render_template('cpanel.html', show_classroom_tabs=False, weekday_option=get_weekday_setting(), error='Invalid option')
     try:
         db.settings.update_one({'_id': 'global'}, {'$set': {'weekdays': option}}, upsert=True)
+        cache_weekday_setting(option)
+        record_history([{'kind': 'settings', 'ts': datetime.now(timezone.utc), 'weekdays': option}])
         return render_template('cpanel.html', show_classroom_tabs=False, weekday_option=option, success='Settings updated')
     except Exception as e:
         logging.error('DB error updating settings: %s', e)
         return render_template('cpanel.html', show_classroom_tabs=False, weekday_option=get_weekday_setting(), error='Failed to update settings')
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'GET':
         return render_template('login.html', show_classroom_tabs=False)
@@ -396,18 +2169,21 @@ def login():
     # POST: authenticate
     username = request.form.get('username')
     password = request.form.get('password')
-    next_url = request.args.get('next') or request.form.get('next') or url_for('index')
+    next_url = request.args.get('next') or request.form.get('next') or url_for('.index')
     
     # Validate input fields
     if not username or not password:
         return render_template('login.html', show_classroom_tabs=False, error='Please enter both username and password')
     
-    user_found = db.users.find_one({"username": username})
+    user_found = db.users.find_one({"username": username}, {'password': 1})
 
     if user_found:
-        # 2. Get the stored password (assuming it's stored as string)
+        # 2. Get the stored password (hash, or plaintext from older databases)
         password_from_db = user_found.get('password')
-        if password_from_db == password:
+        matches, needs_rehash = verify_password(password_from_db, password)
+        if matches:
+            if needs_rehash:
+                upgrade_password_later(username, password_from_db, password)
             session['user'] = username
             return redirect(next_url) # "Login successful!"
         else:
@@ -416,26 +2192,51 @@ def login():
         return render_template('login.html', show_classroom_tabs=False, error='User not found. Please check your username.')
 
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     session.pop('user', None)
     # redirect back to home or referer
     ref = request.headers.get('Referer')
     if ref:
         return redirect(ref)
-    return redirect(url_for('index'))
+    return redirect(url_for('.index'))
 
-@app.route('/insert_lecture', methods=['GET', 'POST']) #allow both GET and POST requests
+def conflict_response(error, message, conflicts):
+    """Return the 409 JSON (AJAX) or HTML page for a rejected write."""
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return jsonify({'success': False, 'error': error, 'conflicts': conflicts}), 409
+    items = ''.join(f"<li>{escape(c.get('course') or '')} - {escape(c.get('instructor') or '')}, classroom {escape(c.get('classroom') or '')} ({escape(c.get('starttime'))}-{escape(c.get('endtime'))})</li>" for c in conflicts)
+    return f'''<html>
+                  <body>
+                  <h1>Conflict detected: {message}</h1>
+                  <ul>{items}</ul>
+                      <a href="/index">Home Page</a> |
+                      <a href="/cpanel">Add lecture</a>
+                  </body>
+                  </html>''', 409
+
+
+def check_conflicts(lecture, exclude_id=None):
+    """Return a conflict response if lecture overlaps its classroom or instructor, else None."""
+    for error, message, conflicts in (
+            ('conflict', 'Classroom is not free during this time slot', has_conflict(lecture, exclude_id)),
+            ('instructor_conflict', 'Instructor is already teaching during this time slot', instructor_conflicts(lecture, exclude_id))):
+        if conflicts:
+            return conflict_response(error, message, conflicts)
+    return None
+
+
+@bp.route('/insert_lecture', methods=['GET', 'POST']) #allow both GET and POST requests
 def insert_lecture():
     """Insert a new lecture."""
     if collection is None:
         return 'Database not configured', 500
 
     # require login to add lectures
-    if not session.get('user'):
+    if not current_user():
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
             return jsonify({'success': False, 'error': 'unauthorized'}), 401
-        return redirect(url_for('login', next=request.path))
+        return redirect(url_for('.login', next=request.path))
 
     course = request.args.get("course") or request.form.get("course")
     days_list = request.args.getlist("days") or request.form.getlist("days")  # Get list of selected days from checkboxes
@@ -451,6 +2252,10 @@ def insert_lecture():
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
             return jsonify({'success': False, 'error': 'starttime and endtime required'}), 400
         return 'starttime and endtime required', 400
+    if not classroom:
+        if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+            return jsonify({'success': False, 'error': 'classroom required'}), 400
+        return 'classroom required', 400
     
     # lecture doc
     lecture = {
@@ -462,29 +2267,254 @@ def insert_lecture():
     "classroom" : classroom,
     "instructor" : instructor
     }
+    lecture.update(time_fields(days, starttime, endtime))
 
-    # conflict check
-    if has_conflict(lecture):
-        return '''<html>
-                  <body>
-                  <h1>Conflict detected: Classroom is not free during this time slot</h1>
-                      <a href="/index">Home Page</a> |
-                      <a href="/cpanel">Add lecture</a>
-                  </body>
-                  </html>'''
+    # conflict checks: the classroom, then the instructor in every classroom
+    resp = check_conflicts(lecture)
+    if resp:
+        return resp
 
-    # insert
-    result = collection.insert_one(lecture)
+    # claim the slots, then insert; a concurrent overlapping writer loses the claim
+    lecture['_id'] = ObjectId()
+    slots = reservation_ids(lecture)
+    holders = reserve_slots(lecture['_id'], slots)
+    if holders is not None:
+        return conflict_response('conflict', 'Time slot was just booked by another lecture', find_lectures(holders))
+    try:
+        collection.insert_one(lecture)
+    except Exception:
+        release_slots(lecture['_id'], slots)
+        raise
+    index_lecture(lecture)
+    record_history([lecture_delta(lecture)])
 
     # AJAX response
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-        lecture_out = lecture.copy()
-        lecture_out['_id'] = str(result.inserted_id)
-        return jsonify({'success': True, 'lecture': lecture_out})
+        return jsonify({'success': True, 'lecture': lecture_out(lecture)})
 
     # redirect back
     target_classroom = classroom if classroom else '1'
     return redirect(f"/index?classroom={target_classroom}")
-# Run app
+
+
+@bp.route('/import_lectures', methods=['POST'])
+def import_lectures_route():
+    """Bulk import lectures from an uploaded CSV or JSON file (JSON report)."""
+    if collection is None:
+        return jsonify({'success': False, 'error': 'Database not configured'}), 500
+    if not current_user():
+        return jsonify({'success': False, 'error': 'unauthorized'}), 401
+
+    upload = request.files.get('file')
+    if upload:
+        data = upload.read()
+        fmt = 'json' if (upload.filename or '').lower().endswith('.json') or upload.mimetype == 'application/json' else 'csv'
+    else:
+        data = request.get_data()
+        fmt = 'json' if request.is_json else 'csv'
+    try:
+        rows = parse_import_rows(data, fmt)
+    except (ValueError, csv.Error) as e:
+        return jsonify({'success': False, 'error': f'Could not parse upload: {e}'}), 400
+
+    ordered = env_flag_value(request.args.get('ordered') or request.form.get('ordered'))
+    report = import_lectures(rows, ordered=ordered)
+    report['success'] = True
+    return jsonify(report)
+
+
+@bp.cli.command('import-lectures')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--ordered', is_flag=True, help='Stop writing at the first insert error.')
+def import_lectures_command(path, ordered):
+    """Bulk import lectures from a CSV or JSON file."""
+    ensure_db()
+    if collection is None:
+        print('Database not configured')
+        return
+    with open(path, 'rb') as f:
+        try:
+            rows = parse_import_rows(f.read(), 'json' if path.lower().endswith('.json') else 'csv')
+        except (ValueError, csv.Error) as e:
+            raise click.ClickException(f'Could not parse {path}: {e}')
+    report = import_lectures(rows, ordered=ordered)
+    for result in report['rows']:
+        if result['status'] != 'ok':
+            print(f"row {result['row']}: {result['status']} {result.get('error') or result.get('conflicting_rows') or [c['_id'] for c in result.get('conflicts', [])]}")
+    print(f"Imported {report['inserted']} of {len(rows)} lectures")
+
+
+def _alternatives(value):
+    """Split a 'a|b' string or list field into its alternatives."""
+    if isinstance(value, (list, tuple)):
+        return [str(v).strip() for v in value if str(v).strip()]
+    return [v.strip() for v in str(value or '').split('|') if v.strip()]
+
+
+def solver_item(ref, row):
+    """Return a solver item for a solve-schedule row, or None if its times are invalid."""
+    patterns = [''.join(sorted(set(p) & set(DAY_CODES))) for p in _alternatives(row.get('days'))]
+    earliest = normalize_minutes(row.get('earliest') or '08:00')
+    latest = normalize_minutes(row.get('latest') or '20:00')
+    duration = student_count(row.get('duration'))
+    if earliest is None or latest is None:
+        return None
+    return solver.make_item(ref, patterns, duration, student_count(row.get('numberOfStudents')),
+                            _alternatives(row.get('classroom')) or None, earliest, latest,
+                            instructor_key(row.get('instructor')))
+
+
+@bp.cli.command('solve-schedule')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--budget', default=10.0, show_default=True, help='Search time in seconds.')
+@click.option('--workers', default=1, show_default=True, help='Processes searching from different seeds.')
+@click.option('--output', type=click.Path(dir_okay=False), help='Write the placed lectures to this JSON file.')
+@click.option('--apply', 'apply_', is_flag=True, help='Insert the placed lectures.')
+def solve_schedule_command(path, budget, workers, output, apply_):
+    """Assign classrooms and times to a CSV or JSON batch of unplaced lectures.
+
+    Rows give course, instructor, days (alternative patterns separated by
+    '|', e.g. 13|24), duration in minutes, numberOfStudents, and optionally
+    classroom (allowed rooms separated by '|') and earliest/latest (HH:MM).
+    """
+    ensure_db()
+    if collection is None:
+        print('Database not configured')
+        return
+    with open(path, 'rb') as f:
+        rows = parse_import_rows(f.read(), 'json' if path.lower().endswith('.json') else 'csv')
+    items = []
+    for i, row in enumerate(rows):
+        item = solver_item(i, row) if isinstance(row, dict) else None
+        if item is None:
+            print(f'row {i + 1}: invalid')
+        else:
+            items.append(item)
+
+    rooms = sorted(set(CLASSROOMS) | {r for item in items for r in item['rooms'] or ()})
+    instructors = {item['instructor'] for item in items} - {None}
+    ensure_classrooms_loaded(rooms)
+    if instructors:
+        ensure_all_loaded()
+    with _index_lock:
+        busy = {(r, d): classroom_index.busy_bits(r, d) for r in rooms for d in DAY_CODES}
+        busy.update({(('instructor', i), d): instructor_index.busy_bits(i, d) for i in instructors for d in DAY_CODES})
+    result = solver.solve(items, rooms, busy, {r: room_capacity(r) for r in rooms}, budget=budget, workers=workers)
+
+    lectures = []
+    for ref, (room, pattern, start, end) in sorted(result['placed'].items()):
+        row = rows[ref]
+        lecture = {'course': row.get('course'), 'instructor': row.get('instructor'), 'days': pattern,
+                   'starttime': format_minutes(start), 'endtime': format_minutes(end),
+                   'numberOfStudents': row.get('numberOfStudents'), 'classroom': room}
+        lecture.update(time_fields(pattern, lecture['starttime'], lecture['endtime']))
+        lectures.append(lecture)
+
+    # the placement must pass the same checks as insert_lecture and the importer
+    clashes = [lec['course'] for lec in lectures if has_conflict(lec) or instructor_conflicts(lec)]
+    intervals = [(key, d, lec['start_min'], lec['end_min'], n)
+                 for n, lec in enumerate(lectures) for key in sweep_keys(lec) for d in lec['days']]
+    clashes += [lectures[b]['course'] for _, b in find_overlaps(intervals)]
+    if clashes:
+        raise click.ClickException(f'solver produced conflicting placements: {clashes}')
+
+    for ref, reason in sorted(result['unplaced'].items()):
+        print(f'row {ref + 1}: unplaced ({reason})')
+    for lec in lectures:
+        print(f"{lec['course']}: classroom {lec['classroom']}, days {lec['days']}, {lec['starttime']}-{lec['endtime']}")
+    print(f"Placed {len(lectures)} of {len(rows)} lectures")
+    if output:
+        with open(output, 'w') as f:
+            json.dump([{k: v for k, v in lec.items() if k in IMPORT_FIELDS} for lec in lectures], f, indent=2)
+    if apply_:
+        report = import_lectures([{k: v for k, v in lec.items() if k in IMPORT_FIELDS} for lec in lectures])
+        print(f"Inserted {report['inserted']} lectures")
+
+
+@bp.cli.command('init-db')
+def init_db_command():
+    """Create the default admin user, settings, indexes and slot reservations."""
+    if _db_pid != os.getpid():
+        connect_db()
+    if db is None:
+        print('Database not configured')
+        return
+    if init_db():
+        print('Database initialized')
+    else:
+        print('Database initialization failed; see the log')
+
+
+@bp.cli.command('rebuild-reservations')
+def rebuild_reservations_command():
+    """Recreate the slot reservations from the stored lectures."""
+    ensure_db()
+    if collection is None:
+        print('Database not configured')
+        return
+    lectures, clashes = rebuild_reservations()
+    print(f'Reserved slots for {lectures} lectures')
+    if clashes:
+        print(f'{clashes} lectures overlap an earlier one; see /conflicts')
+
+
+@bp.cli.command('migrate-times')
+def migrate_times():
+    """Store start_min/end_min/day_mask on lectures saved before they existed."""
+    ensure_db()
+    if collection is None:
+        print('Database not configured')
+        return
+    missing = {'$or': [{'start_min': {'$exists': False}}, {'end_min': {'$exists': False}}, {'day_mask': {'$exists': False}}]}
+    ops = []
+    migrated = 0
+    for lec in collection.find(missing, {'days': 1, 'starttime': 1, 'endtime': 1}):
+        ops.append(UpdateOne({'_id': lec['_id']}, {'$set': time_fields(lec.get('days'), lec.get('starttime'), lec.get('endtime'))}))
+        if len(ops) >= 500:
+            migrated += collection.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if ops:
+        migrated += collection.bulk_write(ops, ordered=False).modified_count
+    print(f'Migrated {migrated} lectures')
+
+def _after_fork():
+    """Give a forked worker its own locks; the client is recreated lazily."""
+    global _index_lock, _db_lock, _kdf_slots
+    _index_lock = threading.RLock()
+    _db_lock = threading.Lock()
+    _kdf_slots = threading.BoundedSemaphore(PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE)
+    classroom_index._lock = threading.RLock()
+    instructor_index._lock = threading.RLock()
+    # ensure_db reconnects on first use, since _db_pid is the parent's
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def ensure_db_for_request():
+    """Connect and bootstrap on the first request that needs the database."""
+    if request.endpoint not in ('static', 'metrics', 'main.healthz'):
+        ensure_db()
+
+
+def create_app():
+    """Create the Flask application; the database is connected on first use."""
+    app = Flask(__name__)
+    # Secret key
+    app.secret_key = os.getenv('FLASK_SECRET_KEY', 'change-this-secret')
+    # compiled templates persist across restarts and workers
+    app.jinja_options = dict(app.jinja_options, bytecode_cache=FileSystemBytecodeCache(os.getenv('JINJA_CACHE_DIR') or None))
+    app.add_template_global(static_url)
+    app.register_blueprint(bp)
+    app.after_request(static_cache_headers)
+    app.after_request(compress_response)
+    metrics.init_app(app)
+    app.before_request(ensure_db_for_request)
+    return app
+
+
+app = create_app()
+
+# Run app (development server; see wsgi.py and gunicorn.conf.py for production)
 if __name__ == '__main__':
-    app.run(debug=True, port=5000)  # Run app in debug mode on port 5000
+    app.run(debug=env_flag('FLASK_DEBUG', True), port=int(os.getenv('PORT', '5000')))
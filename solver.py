@@ -0,0 +1,219 @@
+# Batch room/time assignment for unplaced lectures.
+#
+# Every (room, day) and (('instructor', key), day) is an int bitmap of busy
+# minutes, seeded from the live timetable, so a placement must find both its
+# room and its instructor free. A greedy pass places the most constrained lectures first, then
+# a local search moves single blocking lectures out of the way to fit the
+# ones left over, until the time budget runs out. With several workers each
+# process searches from a different random seed and the best result wins.
+import os
+import time
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+# Granularity of candidate start times, in minutes
+SLOT_MINUTES = int(os.getenv('SOLVER_SLOT_MINUTES', '30'))
+# Teaching day used when an item gives no earliest/latest time
+DAY_START = 8 * 60
+DAY_END = 20 * 60
+
+
+def span_bits(start, end):
+    """Return an int bitmap with bits start..end-1 set."""
+    return ((1 << (end - start)) - 1) << start if end > start else 0
+
+
+def make_item(ref, patterns, duration, students=None, rooms=None, earliest=DAY_START, latest=DAY_END, instructor=None):
+    """Return a solver item: a lecture to place on one of patterns (day-code strings).
+
+    instructor is a normalized key; items sharing one never overlap.
+    """
+    return {
+        'ref': ref,
+        'patterns': [p for p in patterns if p],
+        'duration': duration,
+        'students': students,
+        'rooms': rooms,
+        'earliest': earliest,
+        'latest': latest,
+        'instructor': instructor,
+    }
+
+
+def candidates(item, rooms, capacity):
+    """Return (candidate list, reason) for an item; a candidate is (room, pattern, start)."""
+    if not item['patterns']:
+        return [], 'no allowed days'
+    if not item['duration'] or item['duration'] <= 0:
+        return [], 'invalid duration'
+    allowed = [r for r in rooms if item['rooms'] is None or r in item['rooms']]
+    if not allowed:
+        return [], 'no allowed classroom'
+    students = item['students']
+    fitting = [r for r in allowed if students is None or capacity.get(r) is None or capacity[r] >= students]
+    if not fitting:
+        return [], f'no classroom holds {students} students'
+    # snap the first start to the slot grid
+    first = -(-item['earliest'] // SLOT_MINUTES) * SLOT_MINUTES
+    starts = list(range(first, item['latest'] - item['duration'] + 1, SLOT_MINUTES))
+    if not starts:
+        return [], 'duration does not fit between earliest and latest'
+
+    def slack(room):
+        cap = capacity.get(room)
+        return cap - students if cap is not None and students is not None else float('inf')
+
+    # smallest adequate room first, then earliest start
+    cands = [(room, pattern, start) for room in sorted(fitting, key=slack) for start in starts for pattern in item['patterns']]
+    return cands, None
+
+
+class _Search:
+    """One search run: base occupancy plus the batch placed so far."""
+
+    def __init__(self, problem, seed):
+        self.items = problem['items']
+        self.cands = problem['candidates']
+        self.base = problem['busy']
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.batch = {}  # (room or instructor, day) -> batch-only busy bits
+        self.owners = {}  # (room or instructor, day) -> {ref: (start, end)}
+        self.placed = {}  # ref -> (room, pattern, start)
+
+    def _mask(self, ref, cand):
+        start = cand[2]
+        return span_bits(start, start + self.items[ref]['duration'])
+
+    def _slots(self, ref, cand):
+        """Return the (room or instructor, day) bitmaps cand occupies."""
+        room, pattern, _ = cand
+        who = self.items[ref]['instructor']
+        return [(r, d) for r in ([room, ('instructor', who)] if who else [room]) for d in pattern]
+
+    def fits(self, ref, cand):
+        mask = self._mask(ref, cand)
+        return all(not ((self.base.get(slot, 0) | self.batch.get(slot, 0)) & mask) for slot in self._slots(ref, cand))
+
+    def place(self, ref, cand):
+        mask = self._mask(ref, cand)
+        start = cand[2]
+        for slot in self._slots(ref, cand):
+            self.batch[slot] = self.batch.get(slot, 0) | mask
+            self.owners.setdefault(slot, {})[ref] = (start, start + self.items[ref]['duration'])
+        self.placed[ref] = cand
+
+    def unplace(self, ref):
+        cand = self.placed.pop(ref)
+        mask = self._mask(ref, cand)
+        for slot in self._slots(ref, cand):
+            # batch placements never overlap, so XOR clears exactly this one
+            self.batch[slot] ^= mask
+            del self.owners[slot][ref]
+
+    def blockers(self, ref, cand):
+        """Return the batch items in the way of cand, or None if the live timetable blocks it."""
+        mask = self._mask(ref, cand)
+        start = cand[2]
+        end = start + self.items[ref]['duration']
+        found = set()
+        for slot in self._slots(ref, cand):
+            if self.base.get(slot, 0) & mask:
+                return None
+            for other, (s, e) in self.owners.get(slot, {}).items():
+                if s < end and start < e:
+                    found.add(other)
+        return found
+
+    def first_fit(self, ref, skip=None):
+        for cand in self.cands[ref]:
+            if cand != skip and self.fits(ref, cand):
+                return cand
+        return None
+
+    def greedy(self):
+        refs = [r for r in self.items if self.cands[r]]
+        self.rng.shuffle(refs)
+        # most constrained and largest first; the shuffle breaks ties per seed
+        refs.sort(key=lambda r: (len(self.cands[r]), -self.items[r]['duration'] * len(self.items[r]['patterns'][0])))
+        for ref in refs:
+            cand = self.first_fit(ref)
+            if cand:
+                self.place(ref, cand)
+
+    def improve(self, deadline):
+        """Fit unplaced items by relocating one blocking item at a time."""
+        improved = True
+        while improved and time.monotonic() < deadline:
+            improved = False
+            unplaced = [r for r in self.items if self.cands[r] and r not in self.placed]
+            self.rng.shuffle(unplaced)
+            for ref in unplaced:
+                if time.monotonic() >= deadline:
+                    break
+                cands = list(self.cands[ref])
+                self.rng.shuffle(cands)
+                for cand in cands:
+                    blocking = self.blockers(ref, cand)
+                    if blocking is None or len(blocking) != 1:
+                        continue
+                    other = blocking.pop()
+                    old = self.placed[other]
+                    self.unplace(other)
+                    self.place(ref, cand)
+                    moved = self.first_fit(other, skip=old)
+                    if moved:
+                        self.place(other, moved)
+                        improved = True
+                        break
+                    self.unplace(ref)
+                    self.place(other, old)
+
+    def score(self):
+        return (len(self.placed), -sum(start for _, _, start in self.placed.values()))
+
+
+def _run(args):
+    problem, seed, budget = args
+    deadline = time.monotonic() + budget
+    search = _Search(problem, seed)
+    search.greedy()
+    search.improve(deadline)
+    return search.score(), seed, search.placed
+
+
+def solve(items, rooms, busy, capacity=None, budget=10.0, workers=1, seed=0):
+    """Assign rooms and start times to items without overlapping busy time.
+
+    items is a list from make_item, busy maps (room, day code) and
+    (('instructor', key), day code) to the minute bitmap of the existing
+    timetable, capacity maps room to seats (None if unknown). Returns {'placed': {ref: (room, pattern, start, end)},
+    'unplaced': {ref: reason}, 'seed': winning seed}.
+    """
+    capacity = capacity or {}
+    problem = {'items': {}, 'candidates': {}, 'busy': dict(busy)}
+    unplaced = {}
+    for item in items:
+        cands, reason = candidates(item, rooms, capacity)
+        problem['items'][item['ref']] = item
+        problem['candidates'][item['ref']] = cands
+        if reason:
+            unplaced[item['ref']] = reason
+
+    runs = [(problem, seed + i, budget) for i in range(max(1, workers))]
+    if len(runs) == 1:
+        results = [_run(runs[0])]
+    else:
+        with ProcessPoolExecutor(max_workers=len(runs)) as pool:
+            results = list(pool.map(_run, runs))
+    _, best_seed, placed = max(results, key=lambda r: r[0])
+
+    for ref in problem['items']:
+        if ref not in placed and ref not in unplaced:
+            unplaced[ref] = 'no free slot found'
+    return {
+        'placed': {ref: (room, pattern, start, start + problem['items'][ref]['duration'])
+                   for ref, (room, pattern, start) in placed.items()},
+        'unplaced': unplaced,
+        'seed': best_seed,
+    }
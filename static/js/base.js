@@ -0,0 +1,23 @@
+function openPage(classroom) {
+  // archived views stay at the same point in time
+  var asOf = new URLSearchParams(window.location.search).get('as_of');
+  window.location.href = '/index?classroom='+classroom + (asOf ? '&as_of='+encodeURIComponent(asOf) : '');
+  var i, tablinks;
+  tablinks = document.getElementsByClassName("tablink");
+  for (i = 0; i < tablinks.length; i++) {
+    tablinks[i].style.backgroundColor = "";
+  }
+}
+if (document.body.dataset.classroom && document.getElementById("CLASSROOM" + document.body.dataset.classroom + "link")) {
+  document.getElementById("CLASSROOM" + document.body.dataset.classroom + "link").style.backgroundColor = 'orange';
+}
+
+var currentPath = window.location.pathname;
+var navLinks = document.querySelectorAll('.navbar a');
+navLinks.forEach(function(link) {
+  if (link.getAttribute('href') === currentPath) {
+    link.classList.add('active');
+  } else {
+    link.classList.remove('active');
+  }
+});
@@ -0,0 +1,128 @@
+const SCHEDULE = document.getElementById('schedule-data').dataset;
+const IS_LOGGED_IN = SCHEDULE.loggedIn === 'true';
+function timeKeyToHHMM(key){
+  return key + ':00';
+}
+
+document.addEventListener('DOMContentLoaded', function(){
+  // attach click to every cell only if user is logged in
+  document.querySelectorAll('.cell').forEach(function(el){
+    if(IS_LOGGED_IN){
+      el.style.cursor = 'pointer';
+      el.addEventListener('click', async function(){
+      const day = this.dataset.day;
+      const time = this.dataset.time; // e.g. '08'
+      const classroom = this.dataset.classroom;
+      // open modal
+      const modal = document.getElementById('cpanel-modal');
+      modal.style.display = 'flex';
+      // prepare form
+      const form = document.getElementById('cpanel-form');
+      form.action = '/insert_lecture';
+      document.getElementById('lecture-id').value = '';
+        // prefill classroom and time
+      document.getElementById('classroom-select').value = classroom;
+      document.getElementById('starttime').value = timeKeyToHHMM(time);
+      document.getElementById('endtime').value = '';
+      document.getElementById('course').value = '';
+      document.getElementById('instructor').value = '';
+      document.getElementById('numberOfStudents').value = '';
+      // clear days dynamically
+      ['1','2','3','4','5'].forEach(function(code){
+        const cb = document.getElementById('day_'+code);
+        if(cb) cb.checked = false;
+      });
+
+      // fetch existing lecture for this slot
+      try{
+        const resp = await fetch(`/get_lecture?classroom=${encodeURIComponent(classroom)}&day=${encodeURIComponent(day)}&time=${encodeURIComponent(time)}`);
+        if(resp.ok){
+          const data = await resp.json();
+          if(data && data._id){
+            // fill form for editing
+            document.getElementById('lecture-id').value = data._id;
+            document.getElementById('course').value = data.course || '';
+            document.getElementById('instructor').value = data.instructor || '';
+            document.getElementById('starttime').value = data.starttime || '';
+            document.getElementById('endtime').value = data.endtime || '';
+            document.getElementById('numberOfStudents').value = data.numberOfStudents || '';
+            document.getElementById('classroom-select').value = data.classroom || classroom;
+            // set days
+            if(data.days){
+              // data.days is string like '13'
+              for(const ch of data.days){
+                const el = document.getElementById('day_'+ch);
+                if(el) el.checked = true;
+              }
+            }
+            // change form action to update
+            form.action = '/update_lecture';
+          }
+        }
+      }catch(e){
+        console.error('Could not fetch lecture:', e);
+      }
+      });
+    }else{
+      // not logged in: visually indicate non-editable
+      el.style.cursor = 'default';
+      el.title = 'Login to edit';
+    }
+  });
+
+  // close button
+  document.getElementById('cpanel-close').addEventListener('click', function(){
+    document.getElementById('cpanel-modal').style.display = 'none';
+  });
+});
+
+// live updates: patch changed cells in place instead of re-fetching the page
+function patchCells(cells){
+  cells.forEach(function(c){
+    const el = document.querySelector('.cell[data-day="' + c.day + '"][data-time="' + c.time + '"]');
+    if (el && el.textContent !== c.text) el.textContent = c.text;
+  });
+}
+
+if (!SCHEDULE.asOf && SCHEDULE.live === 'sse' && window.EventSource) {
+  const events = new EventSource('/events?classroom=' + encodeURIComponent(SCHEDULE.classroom) + '&etag=' + encodeURIComponent(SCHEDULE.gridEtag));
+  events.addEventListener('cells', function(e){
+    patchCells(JSON.parse(e.data));
+  });
+  events.addEventListener('reload', function(){
+    window.location.reload();
+  });
+} else if (!SCHEDULE.asOf && SCHEDULE.live === 'poll') {
+  const days = [];
+  document.querySelectorAll('.cell').forEach(function(el){
+    if (days.indexOf(el.dataset.day) < 0) days.push(el.dataset.day);
+  });
+  let etag = '"' + SCHEDULE.gridEtag + '"';
+  setInterval(async function(){
+    if (document.hidden) return;
+    try {
+      const resp = await fetch('/schedule?classroom=' + encodeURIComponent(SCHEDULE.classroom), {
+        cache: 'no-store',
+        headers: {'If-None-Match': etag}
+      });
+      // 304: the grid has not changed since the last poll
+      if (!resp.ok) return;
+      etag = resp.headers.get('ETag') || etag;
+      const data = await resp.json();
+      if (data.days.join() !== days.join()) {
+        window.location.reload();
+        return;
+      }
+      const grid = data.classrooms[SCHEDULE.classroom] || {};
+      const cells = [];
+      Object.keys(grid).forEach(function(day){
+        Object.keys(grid[day]).forEach(function(time){
+          cells.push({day: day, time: time, text: grid[day][time]});
+        });
+      });
+      patchCells(cells);
+    } catch (e) {
+      // try again on the next tick
+    }
+  }, Number(SCHEDULE.pollSeconds) * 1000);
+}
@@ -0,0 +1,10 @@
+# Production entry point
+#   gunicorn -c gunicorn.conf.py wsgi:app     (Linux/macOS, multi-process)
+#   python wsgi.py                            (waitress, multi-threaded; works on Windows)
+import os
+from server import app
+
+if __name__ == '__main__':
+    from waitress import serve
+    serve(app, host=os.getenv('HOST', '0.0.0.0'), port=int(os.getenv('PORT', '5000')),
+          threads=int(os.getenv('WAITRESS_THREADS', '8')))